@@ -1,12 +1,43 @@
-from flask import Flask, render_template_string, request, redirect, session
+from flask import Flask, render_template_string, request, redirect, session, Response, abort, jsonify, stream_with_context
+from flask import before_render_template, template_rendered, g, has_request_context
+from flask.sessions import SessionInterface, SessionMixin
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from itsdangerous import Signer, BadSignature
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+from werkzeug.datastructures import CallbackDict
 import random
+import hmac
+import hashlib
 import json
+import base64
+import math
+import struct
+import sys
+import queue
+import glob
+import atexit
 import os
-from datetime import datetime
+import csv
+import io
+import zlib
+import time
+import secrets
+import socket
+import socketserver
+import threading
+import re
+from datetime import datetime, timedelta
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
 
 # ============================================================================
 # CONFIG
@@ -15,19 +46,100 @@ from werkzeug.security import generate_password_hash, check_password_hash
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', os.urandom(32).hex())
 
+# Multi-node mode: sessions and payment state live in a shared backend
+# (memory:// for a single process, redis://host:port/db across nodes)
+STATE_BACKEND_URL = os.environ.get('STATE_BACKEND')
+if STATE_BACKEND_URL and not os.environ.get('SECRET_KEY'):
+    raise RuntimeError("SECRET_KEY must be set and shared by all nodes when STATE_BACKEND is configured")
+# How long a node's claim on a status change is kept; must outlast background retries of publishing it
+SHARED_CLAIM_TTL = int(os.environ.get('SHARED_CLAIM_TTL', 7 * 24 * 60 * 60))
+
+# Status transitions and the job queue rely on UPDATE ... RETURNING
+if sqlite3.sqlite_version_info < (3, 35, 0):
+    raise RuntimeError(f"SQLite 3.35+ is required, found {sqlite3.sqlite_version}")
+
 BANK_CARD = os.environ.get('BANK_CARD', "5599 0021 1503 7915")
 ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME', "admin")
 ADMIN_PASSWORD_HASH = generate_password_hash(os.environ.get('ADMIN_PASSWORD', "admin"))
 
+ADMIN_SESSION_TTL = int(os.environ.get('ADMIN_SESSION_TTL', 12 * 60 * 60))
+ADMIN_HASH_WORKERS = int(os.environ.get('ADMIN_HASH_WORKERS', 2))
+ADMIN_HASH_QUEUE = int(os.environ.get('ADMIN_HASH_QUEUE', 8))
+ADMIN_LOGIN_MAX_FAILURES = int(os.environ.get('ADMIN_LOGIN_MAX_FAILURES', 5))
+ADMIN_LOGIN_IP_MAX_FAILURES = int(os.environ.get('ADMIN_LOGIN_IP_MAX_FAILURES', 20))
+ADMIN_LOGIN_WINDOW = int(os.environ.get('ADMIN_LOGIN_WINDOW', 15 * 60))
+ADMIN_LOGIN_LOCKOUT = int(os.environ.get('ADMIN_LOGIN_LOCKOUT', 15 * 60))
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+MAX_ORDER_QUANTITY = int(os.environ.get('MAX_ORDER_QUANTITY', 5000))
+CREDENTIALS_PAGE_SIZE = int(os.environ.get('CREDENTIALS_PAGE_SIZE', 20))
+SUCCESS_PAGE_CACHE_BYTES = int(os.environ.get('SUCCESS_PAGE_CACHE_BYTES', 32 * 1024 * 1024))
+CREDENTIALS_BLOOM_CAPACITY = int(os.environ.get('CREDENTIALS_BLOOM_CAPACITY', 1000000))
+
+ADMIN_SEARCH_LIMIT = int(os.environ.get('ADMIN_SEARCH_LIMIT', 200))
+ADMIN_CHANGES_LIMIT = int(os.environ.get('ADMIN_CHANGES_LIMIT', 500))
+ADMIN_STREAM_POLL_INTERVAL = float(os.environ.get('ADMIN_STREAM_POLL_INTERVAL', 1))
+ADMIN_STREAM_MAX_AGE = float(os.environ.get('ADMIN_STREAM_MAX_AGE', 300))
+
+PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', 5))
+PROFILER_MAX_SQL = int(os.environ.get('PROFILER_MAX_SQL', 200))
+SLOW_REQUEST_THRESHOLD_MS = float(os.environ.get('SLOW_REQUEST_THRESHOLD_MS', 1000))
+SLOW_REQUEST_CAPTURES = int(os.environ.get('SLOW_REQUEST_CAPTURES', 50))
+PROFILER_SYNC_INTERVAL = float(os.environ.get('PROFILER_SYNC_INTERVAL', 1))
+
+LOG_DIR = os.environ.get('LOG_DIR', 'logs')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 500))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 1))
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_ROTATE_SECONDS = int(os.environ.get('LOG_ROTATE_SECONDS', 24 * 60 * 60))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 7))
+
+PAYMENT_EXPIRY_HOURS = float(os.environ.get('PAYMENT_EXPIRY_HOURS', 24))
+PAYMENT_EXPIRY_CHECK_INTERVAL = float(os.environ.get('PAYMENT_EXPIRY_CHECK_INTERVAL', 300))
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get('JOB_VISIBILITY_TIMEOUT', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 8))
+JOB_RETRY_BASE = float(os.environ.get('JOB_RETRY_BASE', 10))
+JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', 24))
+NOTIFY_WEBHOOK_URL = os.environ.get('NOTIFY_WEBHOOK_URL', '')
+NOTIFY_WEBHOOK_SECRET = os.environ.get('NOTIFY_WEBHOOK_SECRET', '')
+if NOTIFY_WEBHOOK_URL and not NOTIFY_WEBHOOK_SECRET:
+    raise RuntimeError("NOTIFY_WEBHOOK_SECRET must be set when NOTIFY_WEBHOOK_URL is configured")
+NOTIFY_TIMEOUT = float(os.environ.get('NOTIFY_TIMEOUT', 10))
+
+PAYMENT_LOOKUP_TTL = float(os.environ.get('PAYMENT_LOOKUP_TTL', 1))
+
+REPORT_DB_PATH = os.environ.get('REPORT_DB_PATH', 'payments_report.db')
+REPORT_REFRESH_INTERVAL = float(os.environ.get('REPORT_REFRESH_INTERVAL', 60))
+
+CATALOG_PATH = os.environ.get('CATALOG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json'))
+CATALOG_POLL_INTERVAL = float(os.environ.get('CATALOG_POLL_INTERVAL', 2))
+
+# Storefront registry keyed by host; without it the env settings above form
+# the single "default" storefront that answers on every host
+TENANTS_PATH = os.environ.get('TENANTS_PATH', '')
+DEFAULT_TENANT_ID = "default"
+SLUG_RE = re.compile(r"[a-z0-9_-]+")
+COLOR_RE = re.compile(r"#[0-9A-Fa-f]{6}")
+MARKUP_RE = re.compile(r"[{}<>]")
+CARD_RE = re.compile(r"[0-9 ]{12,23}")
+
 
 # ============================================================================
 # DATABASE
 # ============================================================================
 
 def init_db():
-    conn = sqlite3.connect('payments.db')
+    conn = _connect()
     c = conn.cursor()
 
+    # WAL lets long-running readers (exports) coexist with writers
+    c.execute("PRAGMA journal_mode=WAL")
+
     c.execute('''
         CREATE TABLE IF NOT EXISTS payments (
             payment_id TEXT PRIMARY KEY,
@@ -50,15 +162,1635 @@ def init_db():
         except sqlite3.Error:
             pass
 
+    if 'change_seq' not in columns:
+        c.execute("ALTER TABLE payments ADD COLUMN change_seq INTEGER")
+        c.execute("UPDATE payments SET change_seq = rowid")
+
+    if 'tenant_id' not in columns:
+        c.execute(f"ALTER TABLE payments ADD COLUMN tenant_id TEXT NOT NULL DEFAULT '{DEFAULT_TENANT_ID}'")
+
+    try:
+        # Expiry and node sync look up pending payments by age; every other query is per storefront
+        c.execute('DROP INDEX IF EXISTS idx_payments_status')
+        c.execute('DROP INDEX IF EXISTS idx_payments_timestamp')
+        c.execute('DROP INDEX IF EXISTS idx_payments_change_seq')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_payments_status_timestamp ON payments (status, timestamp)')
+        # Admin search always filters by storefront first, so its indexes lead with tenant_id
+        c.execute('DROP INDEX IF EXISTS idx_payments_amount')
+        c.execute('DROP INDEX IF EXISTS idx_payments_country')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_payments_tenant_payment ON payments (tenant_id, payment_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_payments_tenant_amount ON payments (tenant_id, amount, timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_payments_tenant_country ON payments (tenant_id, country_id, timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_payments_tenant_status ON payments (tenant_id, status, timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_payments_tenant_timestamp ON payments (tenant_id, timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_payments_tenant_change_seq ON payments (tenant_id, change_seq)')
+    except sqlite3.Error:
+        pass
+
+    # Every insert, update and delete of a payment takes the next value of a
+    # monotonic change sequence, so the admin queue can fetch only what changed
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS change_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO change_counter (id, value) SELECT 1, COALESCE(MAX(change_seq), 0) FROM payments")
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS payment_deletions (
+            change_seq INTEGER PRIMARY KEY,
+            payment_id TEXT NOT NULL
+        )
+    ''')
+
+    c.execute("PRAGMA table_info(payment_deletions)")
+    if 'tenant_id' not in [column[1] for column in c.fetchall()]:
+        c.execute(f"ALTER TABLE payment_deletions ADD COLUMN tenant_id TEXT NOT NULL DEFAULT '{DEFAULT_TENANT_ID}'")
+        # The delete trigger predates the column and is recreated below
+        c.execute("DROP TRIGGER IF EXISTS payments_change_delete")
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS payment_credentials (
+            payment_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            ip TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            login TEXT NOT NULL,
+            password TEXT NOT NULL,
+            PRIMARY KEY (payment_id, position)
+        ) WITHOUT ROWID
+    ''')
+
+    # Move credentials of orders confirmed before the child table existed
+    c.execute("SELECT payment_id, proxy_data FROM payments WHERE proxy_data LIKE '[%'")
+    for payment_id, proxy_data in c.fetchall():
+        try:
+            _store_credentials(conn, payment_id, json.loads(proxy_data))
+        except (json.JSONDecodeError, ValueError, KeyError, TypeError, sqlite3.IntegrityError):
+            continue
+        c.execute("UPDATE payments SET proxy_data='' WHERE payment_id=?", (payment_id,))
+
+    # Legacy logins (user1000-user9999) repeat; only the current 12-character
+    # format is unique, so the index skips the old ones
+    try:
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_credentials_login ON payment_credentials (login) '
+                  'WHERE length(login) > 8')
+    except sqlite3.Error:
+        pass
+
+    # Legacy endpoints may also collide; then uniqueness relies on the in-memory filter alone
     try:
-        c.execute('CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status)')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_credentials_endpoint ON payment_credentials (ip, port)')
     except sqlite3.Error:
         pass
 
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS payment_transitions (
+            id INTEGER PRIMARY KEY,
+            payment_id TEXT NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            changed_at DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_transitions_payment ON payment_transitions (payment_id, id)')
+
+    # run_at doubles as the lease deadline while a job is running
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            tenant_id TEXT NOT NULL DEFAULT 'default',
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL,
+            last_error TEXT,
+            created_at DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+        )
+    ''')
+    c.execute("PRAGMA table_info(jobs)")
+    if 'tenant_id' not in [column[1] for column in c.fetchall()]:
+        c.execute(f"ALTER TABLE jobs ADD COLUMN tenant_id TEXT NOT NULL DEFAULT '{DEFAULT_TENANT_ID}'")
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, run_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_tenant ON jobs (tenant_id, status)')
+
+    # Profiler window, merged stacks and slow-request captures shared by all worker processes
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS profiler_window (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            session INTEGER NOT NULL,
+            active INTEGER NOT NULL,
+            deadline REAL,
+            remaining INTEGER,
+            endpoint TEXT
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS profiler_stacks (
+            stack TEXT PRIMARY KEY,
+            samples INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE TABLE IF NOT EXISTS profiler_captures (id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+
+    # Admin sessions and login throttling when there is no shared state backend
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS admin_auth (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+    c.executescript('''
+        CREATE TRIGGER IF NOT EXISTS payments_transition_insert AFTER INSERT ON payments
+        BEGIN
+            INSERT INTO payment_transitions (payment_id, from_status, to_status)
+            VALUES (NEW.payment_id, NULL, NEW.status);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS payments_transition_update AFTER UPDATE OF status ON payments
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            INSERT INTO payment_transitions (payment_id, from_status, to_status)
+            VALUES (NEW.payment_id, OLD.status, NEW.status);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS payments_credentials_delete AFTER DELETE ON payments
+        BEGIN
+            DELETE FROM payment_credentials WHERE payment_id = OLD.payment_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS payments_change_insert AFTER INSERT ON payments
+        BEGIN
+            UPDATE change_counter SET value = value + 1 WHERE id = 1;
+            UPDATE payments SET change_seq = (SELECT value FROM change_counter WHERE id = 1)
+            WHERE payment_id = NEW.payment_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS payments_change_update
+        AFTER UPDATE OF region_id, country_id, amount, quantity, status, proxy_data ON payments
+        BEGIN
+            UPDATE change_counter SET value = value + 1 WHERE id = 1;
+            UPDATE payments SET change_seq = (SELECT value FROM change_counter WHERE id = 1)
+            WHERE payment_id = NEW.payment_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS payments_change_delete AFTER DELETE ON payments
+        BEGIN
+            UPDATE change_counter SET value = value + 1 WHERE id = 1;
+            INSERT INTO payment_deletions (change_seq, payment_id, tenant_id)
+            VALUES ((SELECT value FROM change_counter WHERE id = 1), OLD.payment_id, OLD.tenant_id);
+        END;
+    ''')
+
     conn.commit()
     conn.close()
 
 
+def _connect():
+    return sqlite3.connect('payments.db', factory=ProfiledConnection)
+
+
+def _connect_readonly():
+    return sqlite3.connect('file:payments.db?mode=ro', uri=True, factory=ProfiledConnection)
+
+
+def _store_credentials(conn, payment_id, proxies_data):
+    conn.execute("DELETE FROM payment_credentials WHERE payment_id=?", (payment_id,))
+    conn.executemany(
+        "INSERT INTO payment_credentials (payment_id, position, ip, port, login, password) VALUES (?, ?, ?, ?, ?, ?)",
+        ((payment_id, position, proxy["ip"], proxy["port"], proxy["login"], proxy["password"])
+         for position, proxy in enumerate(proxies_data, 1))
+    )
+
+
+def _load_credentials(conn, payment_id, offset, limit):
+    c = conn.cursor()
+    c.execute('''
+        SELECT ip, port, login, password FROM payment_credentials
+        WHERE payment_id=? AND position > ? ORDER BY position LIMIT ?
+    ''', (payment_id, offset, limit))
+    return [dict(zip(("ip", "port", "login", "password"), row)) for row in c.fetchall()]
+
+
+def _iter_credentials(payment_id):
+    conn = _connect_readonly()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT ip, port, login, password FROM payment_credentials WHERE payment_id=? ORDER BY position",
+                  (payment_id,))
+        while True:
+            rows = c.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+# ============================================================================
+# STATE BACKEND
+# ============================================================================
+
+class StateBackendError(Exception):
+    pass
+
+
+STATE_BACKEND_ERRORS = (OSError, StateBackendError)
+
+
+class MemoryStateBackend:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._sets = {}
+
+    def _alive(self, key):
+        entry = self._values.get(key)
+        if entry and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._alive(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None, nx=False):
+        with self._lock:
+            if nx and self._alive(key):
+                return False
+            expires_at = time.monotonic() + ttl if ttl else None
+            self._values[key] = (str(value), expires_at)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            removed_value = self._values.pop(key, None) is not None
+            removed_set = self._sets.pop(key, None) is not None
+            return int(removed_value or removed_set)
+
+    def sadd(self, key, member):
+        member = str(member)
+        with self._lock:
+            members = self._sets.setdefault(key, set())
+            added = member not in members
+            members.add(member)
+            return int(added)
+
+    def srem(self, key, member):
+        member = str(member)
+        with self._lock:
+            members = self._sets.get(key, set())
+            removed = member in members
+            members.discard(member)
+            return int(removed)
+
+    def smembers(self, key):
+        with self._lock:
+            return sorted(self._sets.get(key, ()))
+
+
+def _encode_resp(value):
+    if value is None:
+        return b"$-1\r\n"
+    if value is True:
+        return b"+OK\r\n"
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, (list, tuple)):
+        return f"*{len(value)}\r\n".encode() + b"".join(_encode_resp(item) for item in value)
+    data = str(value).encode('utf-8')
+    return f"${len(data)}\r\n".encode() + data + b"\r\n"
+
+
+def _read_resp(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("state backend closed the connection")
+
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise StateBackendError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        return None if length < 0 else stream.read(length + 2)[:-2].decode('utf-8')
+    if kind == b"*":
+        length = int(rest)
+        return None if length < 0 else [_read_resp(stream) for _ in range(length)]
+    raise StateBackendError(f"unexpected reply: {line!r}")
+
+
+class RedisStateBackend:
+    def __init__(self, host, port=6379, db=0, timeout=5):
+        self._address = (host, port)
+        self._db = db
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._stream = None
+
+    def _roundtrip(self, args):
+        self._sock.sendall(_encode_resp([str(arg) for arg in args]))
+        return _read_resp(self._stream)
+
+    def _connect(self):
+        self._sock = socket.create_connection(self._address, self._timeout)
+        self._stream = self._sock.makefile('rb')
+        if self._db:
+            self._roundtrip(("SELECT", self._db))
+
+    def _close(self):
+        if self._sock is not None:
+            self._stream.close()
+            self._sock.close()
+        self._sock = self._stream = None
+
+    def _command(self, *args):
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                return self._roundtrip(args)
+            except (OSError, ConnectionError):
+                self._close()
+                raise
+
+    def get(self, key):
+        return self._command("GET", key)
+
+    def set(self, key, value, ttl=None, nx=False):
+        args = ["SET", key, value]
+        if ttl:
+            args += ["EX", int(ttl)]
+        if nx:
+            args.append("NX")
+        return self._command(*args) == "OK"
+
+    def delete(self, key):
+        return self._command("DEL", key)
+
+    def sadd(self, key, member):
+        return self._command("SADD", key, member)
+
+    def srem(self, key, member):
+        return self._command("SREM", key, member)
+
+    def smembers(self, key):
+        return sorted(self._command("SMEMBERS", key) or ())
+
+
+class _StateRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                command = _read_resp(self.rfile)
+            except (ConnectionError, StateBackendError, ValueError):
+                return
+            try:
+                reply = self.server.execute(command)
+            except (StateBackendError, ValueError, IndexError) as e:
+                self.wfile.write(f"-ERR {e}\r\n".encode())
+            else:
+                self.wfile.write(_encode_resp(reply))
+
+
+# Minimal RESP server over MemoryStateBackend: a loopback stand-in for Redis
+# when running several nodes locally or in tests
+class LoopbackStateServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, _StateRequestHandler)
+        self.backend = MemoryStateBackend()
+
+    def execute(self, command):
+        name, args = command[0].upper(), command[1:]
+        backend = self.backend
+
+        if name == "PING":
+            return "PONG"
+        if name == "SELECT":
+            return True
+        if name == "GET":
+            return backend.get(args[0])
+        if name == "SET":
+            options = [arg.upper() for arg in args[2:]]
+            ttl = int(args[2 + options.index("EX") + 1]) if "EX" in options else None
+            return True if backend.set(args[0], args[1], ttl=ttl, nx="NX" in options) else None
+        if name == "DEL":
+            return sum(backend.delete(key) for key in args)
+        if name == "SADD":
+            return sum(backend.sadd(args[0], member) for member in args[1:])
+        if name == "SREM":
+            return sum(backend.srem(args[0], member) for member in args[1:])
+        if name == "SMEMBERS":
+            return backend.smembers(args[0])
+        raise StateBackendError(f"unknown command '{name}'")
+
+
+def make_state_backend(url):
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryStateBackend()
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip('/') or 0)
+        return RedisStateBackend(parsed.hostname or '127.0.0.1', parsed.port or 6379, db)
+    raise ValueError(f"Unsupported STATE_BACKEND: {url}")
+
+
+state_backend = make_state_backend(STATE_BACKEND_URL) if STATE_BACKEND_URL else None
+
+
+class BackendSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class BackendSessionInterface(SessionInterface):
+    key_prefix = "session:"
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="mintproxy-session")
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            data = self.backend.get(self.key_prefix + sid) if sid else None
+            if data is not None:
+                return BackendSession(json.loads(data), sid=sid)
+        return BackendSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self.backend.delete(self.key_prefix + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        self.backend.set(self.key_prefix + session.sid, json.dumps(dict(session)), ttl=ttl)
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+if state_backend is not None:
+    app.session_interface = BackendSessionInterface(state_backend)
+
+
+def _load_shared_payment(payment_id):
+    data = state_backend.get(f"payment:{payment_id}")
+    return json.loads(data) if data else None
+
+
+def _publish_payment(record, nx=False):
+    return state_backend.set(f"payment:{record['payment_id']}", json.dumps(record), nx=nx)
+
+
+def _import_shared_payment(conn, payment_id):
+    record = _load_shared_payment(payment_id)
+    if record:
+        conn.execute('''
+            INSERT OR IGNORE INTO payments
+            (payment_id, tenant_id, region_id, country_id, amount, quantity, status, proxy_data, timestamp)
+            VALUES (:payment_id, :tenant_id, :region_id, :country_id, :amount, :quantity, :status, :proxy_data, :timestamp)
+        ''', {"tenant_id": DEFAULT_TENANT_ID, **record})
+
+
+def _import_shared_credentials(payment_id):
+    conn = _connect()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM payment_credentials WHERE payment_id=? LIMIT 1", (payment_id,))
+        if c.fetchone():
+            return
+        data = state_backend.get(f"payment:{payment_id}:credentials")
+        if data:
+            _store_credentials(conn, payment_id, json.loads(data))
+            conn.commit()
+    finally:
+        conn.close()
+
+
+_shared_sync_lock = threading.Lock()
+_shared_sync_at = 0.0
+
+
+def _sync_shared_payments(conn, min_interval=0):
+    # Pull pending payments created on other nodes and settle local rows
+    # that were confirmed or deleted elsewhere. Open admin streams share
+    # one pass per interval instead of syncing on every tick each.
+    global _shared_sync_at
+    with _shared_sync_lock:
+        now = time.monotonic()
+        if min_interval and now - _shared_sync_at < min_interval:
+            return
+        _shared_sync_at = now
+
+    c = conn.cursor()
+    shared_pending = set(state_backend.smembers("payments:pending"))
+    changed = False
+
+    # Only records this node has never seen need a GET
+    c.execute("SELECT value FROM json_each(?) WHERE value NOT IN (SELECT payment_id FROM payments)",
+              (json.dumps(sorted(shared_pending)),))
+    for (payment_id,) in c.fetchall():
+        _import_shared_payment(conn, payment_id)
+        changed = True
+
+    c.execute("SELECT payment_id FROM payments WHERE status='pending'")
+    for (payment_id,) in c.fetchall():
+        if payment_id in shared_pending:
+            continue
+        record = _load_shared_payment(payment_id)
+        if record is None:
+            c.execute("DELETE FROM payments WHERE payment_id=?", (payment_id,))
+            success_pages.invalidate(payment_id)
+        else:
+            c.execute("UPDATE payments SET status=? WHERE payment_id=?", (record['status'], payment_id))
+        payment_lookups.forget(payment_id)
+        changed = True
+
+    if changed:
+        conn.commit()
+
+
+# ============================================================================
+# REPORTING
+# ============================================================================
+
+# Reports never read these, and credentials and session digests should not be copied around
+REPORT_TABLES = ("payments", "change_counter", "payment_deletions", "payment_transitions")
+
+
+def _schema_stamp(conn, schema="main"):
+    schema = conn.execute(f"SELECT sql FROM {schema}.sqlite_master WHERE sql IS NOT NULL ORDER BY name").fetchall()
+    return zlib.crc32("\n".join(sql for (sql,) in schema).encode('utf-8')) & 0x7FFFFFFF
+
+
+class ReportSnapshot:
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+
+    def refreshed_at(self):
+        try:
+            return datetime.fromtimestamp(os.stat(self.path).st_mtime)
+        except OSError:
+            return None
+
+    def age(self):
+        refreshed_at = self.refreshed_at()
+        return (datetime.now() - refreshed_at).total_seconds() if refreshed_at else None
+
+    def refresh(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        target = sqlite3.connect(tmp_path, isolation_level=None)
+        try:
+            target.execute("ATTACH DATABASE 'payments.db' AS live")
+            # Only the reporting tables are copied, credentials and auth data never
+            # reach the file; one read transaction keeps them consistent and under
+            # WAL never blocks writers
+            target.execute("BEGIN")
+            for table in REPORT_TABLES:
+                (sql,) = target.execute("SELECT sql FROM live.sqlite_master WHERE type='table' AND name=?",
+                                        (table,)).fetchone()
+                target.execute(sql)
+                target.execute(f"INSERT INTO main.{table} SELECT * FROM live.{table}")
+            indexes = target.execute(
+                "SELECT sql FROM live.sqlite_master WHERE type='index' AND sql IS NOT NULL AND tbl_name IN "
+                f"({','.join('?' * len(REPORT_TABLES))})", REPORT_TABLES).fetchall()
+            for (sql,) in indexes:
+                target.execute(sql)
+            # The live schema the copy was taken from, to spot copies left over from before an upgrade
+            target.execute(f"PRAGMA main.user_version={_schema_stamp(target, 'live')}")
+            target.execute("COMMIT")
+            target.execute("DETACH DATABASE live")
+            target.close()
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            target.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def connect(self):
+        if not self.interval or self.refreshed_at() is None:
+            return _connect_readonly()
+        return sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, factory=ProfiledConnection)
+
+    def matches_schema(self):
+        if self.refreshed_at() is None:
+            return False
+        live = _connect_readonly()
+        copy = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        try:
+            return copy.execute("PRAGMA user_version").fetchone()[0] == _schema_stamp(live)
+        finally:
+            copy.close()
+            live.close()
+
+    def _run(self):
+        while True:
+            age = self.age()
+            # Another worker may have refreshed the shared file already
+            if age is None or age >= self.interval:
+                try:
+                    self.refresh()
+                except (OSError, sqlite3.Error) as e:
+                    app.logger.warning("Reporting snapshot refresh failed: %s", e)
+                age = 0
+            time.sleep(max(1, self.interval - age))
+
+    def start(self):
+        # A copy made before a schema change would break every report until the next refresh
+        try:
+            if not self.matches_schema():
+                self.refresh()
+        except (OSError, sqlite3.Error) as e:
+            app.logger.warning("Reporting snapshot refresh failed: %s", e)
+        threading.Thread(target=self._run, name="report-snapshot", daemon=True).start()
+
+
+report_snapshot = ReportSnapshot(REPORT_DB_PATH, REPORT_REFRESH_INTERVAL)
+
+
+def _report_staleness_html():
+    age = report_snapshot.age() if report_snapshot.interval else None
+    if age is None:
+        return '<p style="margin-bottom: 15px; color: #666;">Данные из рабочей базы</p>'
+    refreshed_at = report_snapshot.refreshed_at()
+    return (f'<p style="margin-bottom: 15px; color: #666;">Отчетная копия от {refreshed_at:%H:%M:%S} '
+            f'({int(age)} с назад, обновляется каждые {int(report_snapshot.interval)} с)</p>')
+
+
+# ============================================================================
+# PAYMENT STATES
+# ============================================================================
+
+PAYMENT_TRANSITIONS = {
+    "pending": {"success", "expired", "cancelled"},
+    "expired": {"success", "cancelled"},
+    "success": {"refunded"},
+    "cancelled": set(),
+    "refunded": set(),
+}
+
+PAYMENT_STATUS_MESSAGES = {
+    "expired": "Срок ожидания оплаты истек",
+    "cancelled": "Платеж отменен",
+    "refunded": "Средства по платежу возвращены",
+}
+
+PAYMENT_STATUS_COLORS = {
+    "pending": "#e74c3c",
+    "expired": "#95a5a6",
+    "success": "#2ecc71",
+    "cancelled": "#95a5a6",
+    "refunded": "#f39c12",
+}
+
+
+def _transition(conn, payment_id, to_status, tenant_id):
+    # Compare-and-set in one statement: concurrent callers serialize on the
+    # write lock and all but the first see a status that no longer matches
+    sources = [status for status, targets in PAYMENT_TRANSITIONS.items() if to_status in targets]
+    c = conn.cursor()
+    c.execute(f'''
+        UPDATE payments SET status=?
+        WHERE payment_id=? AND tenant_id=? AND status IN ({", ".join("?" * len(sources))})
+        RETURNING quantity
+    ''', [to_status, payment_id, tenant_id, *sources])
+    rows = c.fetchall()
+    return rows[0] if rows else None
+
+
+def _claim_shared_transition(conn, payment_id, to_status, tenant_id):
+    # Each node only sees its own payments.db, so across nodes the shared store
+    # decides: leaving a status is claimed once with SET NX, and the graph has
+    # no cycles, so no status is ever left twice
+    record = _load_shared_payment(payment_id)
+    if (not record or record.get("tenant_id", DEFAULT_TENANT_ID) != tenant_id
+            or to_status not in PAYMENT_TRANSITIONS.get(record["status"], ())):
+        return None
+    if not state_backend.set(f"payment:{payment_id}:left:{record['status']}", to_status,
+                             ttl=SHARED_CLAIM_TTL, nx=True):
+        return None
+
+    # The local copy may lag behind the shared record; bring it up to date before the local CAS
+    _import_shared_payment(conn, payment_id)
+    conn.execute("UPDATE payments SET status=? WHERE payment_id=?", (record["status"], payment_id))
+    return record["status"]
+
+
+def _release_shared_transition(payment_id, from_status):
+    state_backend.delete(f"payment:{payment_id}:left:{from_status}")
+
+
+def _publish_status(payment_id, status):
+    record = _load_shared_payment(payment_id)
+    if record:
+        record.update(status=status)
+        _publish_payment(record)
+    state_backend.srem("payments:pending", payment_id)
+
+
+def expire_stale_payments():
+    cutoff = datetime.now() - timedelta(hours=PAYMENT_EXPIRY_HOURS)
+    conn = _connect()
+    try:
+        c = conn.cursor()
+        if state_backend is None:
+            c.execute("UPDATE payments SET status='expired' WHERE status='pending' AND timestamp < ? "
+                      "RETURNING payment_id, tenant_id", (cutoff,))
+            rows = c.fetchall()
+        else:
+            # Every node sweeps; only the one that wins the shared claim expires the payment
+            c.execute("SELECT payment_id, tenant_id FROM payments WHERE status='pending' AND timestamp < ?", (cutoff,))
+            rows = []
+            for payment_id, tenant_id in c.fetchall():
+                claimed = _claim_shared_transition(conn, payment_id, "expired", tenant_id)
+                if not claimed:
+                    continue
+                if _transition(conn, payment_id, "expired", tenant_id):
+                    rows.append((payment_id, tenant_id))
+                else:
+                    _release_shared_transition(payment_id, claimed)
+        for payment_id, tenant_id in rows:
+            _notify_status(conn, payment_id, "expired", tenant_id)
+        conn.commit()
+    finally:
+        conn.close()
+
+    expired = [payment_id for payment_id, _ in rows]
+    if expired:
+        job_queue.wake()
+
+    for payment_id, tenant_id in rows:
+        payment_lookups.forget(payment_id)
+        if state_backend is not None:
+            _publish_settled(payment_id, "expired", tenant_id)
+    return expired
+
+
+def _expire_loop():
+    while True:
+        try:
+            expire_stale_payments()
+        except (sqlite3.Error, *STATE_BACKEND_ERRORS) as e:
+            app.logger.warning("Payment expiry sweep failed: %s", e)
+        time.sleep(PAYMENT_EXPIRY_CHECK_INTERVAL)
+
+
+def start_payment_expiry():
+    threading.Thread(target=_expire_loop, name="payment-expiry", daemon=True).start()
+
+
+# ============================================================================
+# JOBS
+# ============================================================================
+
+class JobQueue:
+    def __init__(self):
+        self._handlers = {}
+        self._enabled = set()
+        self._wakeup = threading.Event()
+        self._purged_at = 0
+
+    def handler(self, kind, enabled=True):
+        # enabled tells whether this configuration ever enqueues the kind
+        def register(f):
+            self._handlers[kind] = f
+            if enabled:
+                self._enabled.add(kind)
+            return f
+        return register
+
+    def enqueue(self, conn, tenant_id, kind, payload, delay=0):
+        # Runs in the caller's transaction: the job exists only if the change that caused it commits
+        conn.execute("INSERT INTO jobs (tenant_id, kind, payload, run_at) VALUES (?, ?, ?, ?)",
+                     (tenant_id, kind, json.dumps(payload), time.time() + delay))
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _due(self, now):
+        conn = _connect_readonly()
+        try:
+            return conn.execute("SELECT 1 FROM jobs WHERE status IN ('queued', 'running') AND run_at <= ? LIMIT 1",
+                                (now,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def _claim(self):
+        now = time.time()
+        # An idle poll stays a read and never takes the write lock
+        if not self._due(now):
+            return None
+        conn = _connect()
+        try:
+            # A running job whose lease ran out is claimed again: its worker is presumed dead
+            row = conn.execute("""
+                UPDATE jobs SET status='running', attempts=attempts+1, run_at=?
+                WHERE id = (SELECT id FROM jobs WHERE status IN ('queued', 'running') AND run_at <= ?
+                            ORDER BY run_at LIMIT 1)
+                RETURNING id, kind, payload, attempts
+            """, (now + JOB_VISIBILITY_TIMEOUT, now)).fetchone()
+            conn.commit()
+            return row
+        finally:
+            conn.close()
+
+    def _finish(self, job_id, attempts, status, run_at, error=None):
+        conn = _connect()
+        try:
+            # attempts is the lease token: a worker whose lease expired cannot overwrite the new owner
+            conn.execute("UPDATE jobs SET status=?, run_at=?, last_error=? WHERE id=? AND attempts=?",
+                         (status, run_at, error, job_id, attempts))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def run_one(self):
+        job = self._claim()
+        if job is None:
+            return False
+
+        job_id, kind, payload, attempts = job
+        handler = self._handlers.get(kind)
+        try:
+            if handler is None:
+                raise LookupError(f"no handler for job kind {kind!r}")
+            handler(json.loads(payload))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if handler is None or attempts >= JOB_MAX_ATTEMPTS:
+                self._finish(job_id, attempts, 'failed', time.time(), error)
+                audit("job_failed", job_id=job_id, kind=kind, attempts=attempts, error=error)
+            else:
+                backoff = min(3600, JOB_RETRY_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+                self._finish(job_id, attempts, 'queued', time.time() + backoff, error)
+        else:
+            self._finish(job_id, attempts, 'done', time.time())
+        return True
+
+    def _purge(self):
+        if time.time() - self._purged_at < 3600:
+            return
+        self._purged_at = time.time()
+        conn = _connect()
+        try:
+            conn.execute("DELETE FROM jobs WHERE status='done' AND run_at < ?",
+                         (time.time() - JOB_RETENTION_HOURS * 3600,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _work(self):
+        while True:
+            try:
+                if self.run_one():
+                    continue
+                self._purge()
+            except sqlite3.Error as e:
+                app.logger.warning("Job queue poll failed: %s", e)
+            self._wakeup.wait(JOB_POLL_INTERVAL)
+            self._wakeup.clear()
+
+    def start(self, workers):
+        if not self._enabled:
+            return
+        for n in range(workers):
+            threading.Thread(target=self._work, name=f"job-worker-{n}", daemon=True).start()
+
+    def stats(self, tenant_id):
+        conn = _connect_readonly()
+        try:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs WHERE tenant_id=? GROUP BY status",
+                                       (tenant_id,)).fetchall())
+            failed = conn.execute("""
+                SELECT id, kind, attempts, last_error, created_at FROM jobs
+                WHERE tenant_id=? AND status='failed' ORDER BY id DESC LIMIT 20
+            """, (tenant_id,)).fetchall()
+        finally:
+            conn.close()
+        return counts, failed
+
+
+job_queue = JobQueue()
+
+
+def _notify_status(conn, payment_id, status, tenant_id):
+    if NOTIFY_WEBHOOK_URL:
+        job_queue.enqueue(conn, tenant_id, "payment_notify", {
+            "event_id": secrets.token_hex(8),
+            "tenant_id": tenant_id,
+            "payment_id": payment_id,
+            "status": status,
+            "at": datetime.now().isoformat(timespec='seconds'),
+        })
+
+
+@job_queue.handler("payment_notify", enabled=bool(NOTIFY_WEBHOOK_URL))
+def _send_payment_notification(payload):
+    body = json.dumps(payload).encode('utf-8')
+    signature = hmac.new(NOTIFY_WEBHOOK_SECRET.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    req = Request(NOTIFY_WEBHOOK_URL, data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-MintProxy-Signature': signature,
+    })
+    with urlopen(req, timeout=NOTIFY_TIMEOUT) as resp:
+        resp.read()
+
+
+def _publish_settled(payment_id, status, tenant_id, credentials=None):
+    # The local change is already committed; when the shared store is unreachable
+    # the queue keeps retrying so other nodes do not see the payment pending forever
+    try:
+        if credentials is not None:
+            state_backend.set(f"payment:{payment_id}:credentials", json.dumps(credentials))
+        _publish_status(payment_id, status)
+    except STATE_BACKEND_ERRORS as e:
+        app.logger.warning("Publishing payment %s failed, retrying in background: %s", payment_id, e)
+        conn = _connect()
+        try:
+            job_queue.enqueue(conn, tenant_id, "payment_publish", {"payment_id": payment_id, "status": status})
+            conn.commit()
+        except sqlite3.Error as e:
+            app.logger.error("Could not queue publishing of payment %s: %s", payment_id, e)
+        finally:
+            conn.close()
+        job_queue.wake()
+
+
+@job_queue.handler("payment_publish", enabled=state_backend is not None)
+def _republish_payment(payload):
+    payment_id = payload["payment_id"]
+    conn = _connect_readonly()
+    try:
+        row = conn.execute("SELECT status FROM payments WHERE payment_id=?", (payment_id,)).fetchone()
+        credentials = _load_credentials(conn, payment_id, 0, -1)
+    finally:
+        conn.close()
+
+    # A later change or a deletion publishes itself; an old status must not overwrite it
+    if row is None or row[0] != payload["status"]:
+        return
+    if credentials:
+        state_backend.set(f"payment:{payment_id}:credentials", json.dumps(credentials))
+    _publish_status(payment_id, payload["status"])
+
+
+# ============================================================================
+# PROFILING
+# ============================================================================
+
+class ProfiledCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_sql(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_sql(sql, started)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class RequestTrace:
+    def __init__(self, method, path, endpoint, sampled):
+        self.method = method
+        self.path = path
+        self.endpoint = endpoint
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.stacks = Counter()
+        self.sql = []
+        self.templates = []
+        self.template_started = None
+
+
+def _collapse_stack(frame):
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        labels.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def _format_collapsed(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class Profiler:
+    # The window (on/off, deadline, request budget, route) lives in the database so
+    # every worker process follows the same switch; each worker polls it and merges
+    # its samples into the shared profile every sync interval
+    def __init__(self, interval, slow_threshold, max_captures, sync_interval):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.max_captures = max_captures
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.stacks = Counter()
+        self.session = None
+        self.active = False
+        self.deadline = None
+        self.remaining_requests = None
+        self.endpoint = None
+        self._synced_at = 0
+        self._sampler = None
+
+    def start(self, seconds=None, requests=None, endpoint=None):
+        conn = _connect()
+        try:
+            conn.execute("DELETE FROM profiler_stacks")
+            conn.execute("""
+                INSERT INTO profiler_window (id, session, active, deadline, remaining, endpoint)
+                VALUES (1, 1, 1, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET session=session+1, active=1, deadline=excluded.deadline,
+                    remaining=excluded.remaining, endpoint=excluded.endpoint
+            """, (time.time() + seconds if seconds else None, requests, endpoint))
+            conn.commit()
+        finally:
+            conn.close()
+        self.sync()
+        self.ensure_sampler()
+
+    def stop(self):
+        conn = _connect()
+        try:
+            conn.execute("UPDATE profiler_window SET active=0 WHERE id=1")
+            conn.commit()
+        finally:
+            conn.close()
+        self.sync()
+
+    def sync(self):
+        with self.lock:
+            stacks, self.stacks = self.stacks, Counter()
+            session = self.session
+        conn = _connect()
+        try:
+            if stacks:
+                # Samples taken before another worker restarted the window belong to no profile
+                current = conn.execute("SELECT session FROM profiler_window WHERE id=1").fetchone()
+                if current is not None and current[0] == session:
+                    conn.executemany("""
+                        INSERT INTO profiler_stacks (stack, samples) VALUES (?, ?)
+                        ON CONFLICT(stack) DO UPDATE SET samples=samples+excluded.samples
+                    """, stacks.items())
+                    conn.commit()
+            row = conn.execute("SELECT session, active, deadline, remaining, endpoint FROM profiler_window "
+                               "WHERE id=1").fetchone()
+        finally:
+            conn.close()
+
+        self._synced_at = time.monotonic()
+        if row is None:
+            self.active = False
+            return
+        self.session, active, self.deadline, self.remaining_requests, self.endpoint = row
+        self.active = bool(active) and (self.deadline is None or time.time() < self.deadline)
+
+    def _take_request(self):
+        # The request budget is shared, so every worker draws from the same counter
+        try:
+            conn = _connect()
+            try:
+                row = conn.execute("""
+                    UPDATE profiler_window SET remaining=remaining-1, active=remaining>1
+                    WHERE id=1 AND session=? AND active AND remaining > 0
+                    RETURNING remaining
+                """, (self.session,)).fetchone()
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            app.logger.warning("Profiler budget update failed: %s", e)
+            return False
+
+        if row is None:
+            self.active = False
+            return False
+        self.remaining_requests = row[0]
+        if row[0] <= 0:
+            self.active = False
+        return True
+
+    def _window_open(self, endpoint):
+        if self.active and self.deadline is not None and time.time() >= self.deadline:
+            self.active = False
+        if not self.active or (self.endpoint and self.endpoint != endpoint):
+            return False
+        if self.remaining_requests is not None:
+            return self._take_request()
+        return True
+
+    def begin_request(self, method, path, endpoint):
+        if not self.active and not self.slow_threshold:
+            return
+        sampled = self._window_open(endpoint)
+        self.inflight[threading.get_ident()] = RequestTrace(method, path, endpoint, sampled)
+
+    def end_request(self, status_code):
+        trace = self.inflight.pop(threading.get_ident(), None)
+        if trace is None:
+            return
+
+        duration = time.perf_counter() - trace.started
+        if not self.slow_threshold or duration < self.slow_threshold:
+            return
+
+        capture = {
+            "time": datetime.now().isoformat(),
+            "method": trace.method,
+            "path": trace.path,
+            "endpoint": trace.endpoint,
+            "status": status_code,
+            "duration": duration,
+            "stacks": trace.stacks,
+            "sql": sorted(trace.sql, key=lambda item: item[1], reverse=True),
+            "sql_total": sum(elapsed for _, elapsed in trace.sql),
+            "templates": trace.templates,
+            "template_total": sum(elapsed for _, elapsed in trace.templates)
+        }
+        try:
+            conn = _connect()
+            try:
+                capture_id = conn.execute("INSERT INTO profiler_captures (data) VALUES (?)",
+                                          (json.dumps(capture),)).lastrowid
+                conn.execute("DELETE FROM profiler_captures WHERE id <= ?", (capture_id - self.max_captures,))
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            app.logger.warning("Slow request capture failed: %s", e)
+
+    def current(self):
+        return self.inflight.get(threading.get_ident())
+
+    @staticmethod
+    def _load_capture(capture_id, data):
+        capture = json.loads(data)
+        capture.update(id=capture_id, time=datetime.fromisoformat(capture["time"]),
+                       stacks=Counter(capture["stacks"]))
+        return capture
+
+    def captures(self):
+        conn = _connect_readonly()
+        try:
+            rows = conn.execute("SELECT id, data FROM profiler_captures ORDER BY id DESC").fetchall()
+        finally:
+            conn.close()
+        return [self._load_capture(capture_id, data) for capture_id, data in rows]
+
+    def capture(self, capture_id):
+        conn = _connect_readonly()
+        try:
+            row = conn.execute("SELECT id, data FROM profiler_captures WHERE id=?", (capture_id,)).fetchone()
+        finally:
+            conn.close()
+        return self._load_capture(*row) if row else None
+
+    def profile(self):
+        conn = _connect_readonly()
+        try:
+            return Counter(dict(conn.execute("SELECT stack, samples FROM profiler_stacks").fetchall()))
+        finally:
+            conn.close()
+
+    def ensure_sampler(self):
+        with self.lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+                self._sampler.start()
+
+    def _sample_loop(self):
+        while True:
+            # Idle workers only keep polling the shared switch
+            time.sleep(self.interval if self.active or self.slow_threshold else self.sync_interval)
+            if time.monotonic() - self._synced_at >= self.sync_interval:
+                try:
+                    self.sync()
+                except sqlite3.Error as e:
+                    app.logger.warning("Profiler sync failed: %s", e)
+
+            # Slow-request candidates are sampled once they pass half the threshold
+            slow_after = self.slow_threshold / 2 if self.slow_threshold else None
+            now = time.perf_counter()
+            targets = [
+                (thread_id, trace) for thread_id, trace in self.inflight.copy().items()
+                if trace.sampled or (slow_after is not None and now - trace.started >= slow_after)
+            ]
+            if not targets:
+                continue
+
+            frames = sys._current_frames()
+            for thread_id, trace in targets:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = _collapse_stack(frame)
+                trace.stacks[stack] += 1
+                if trace.sampled:
+                    with self.lock:
+                        self.stacks[stack] += 1
+            del frames
+
+
+profiler = Profiler(PROFILER_INTERVAL_MS / 1000, SLOW_REQUEST_THRESHOLD_MS / 1000, SLOW_REQUEST_CAPTURES,
+                    PROFILER_SYNC_INTERVAL)
+
+
+def _record_sql(sql, started):
+    trace = profiler.current()
+    if trace is not None and len(trace.sql) < PROFILER_MAX_SQL:
+        trace.sql.append((" ".join(sql.split()), time.perf_counter() - started))
+
+
+@before_render_template.connect_via(app)
+def _template_started(sender, template, context, **extra):
+    trace = profiler.current()
+    if trace is not None:
+        trace.template_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def _template_finished(sender, template, context, **extra):
+    trace = profiler.current()
+    if trace is not None and trace.template_started is not None:
+        trace.templates.append((template.name or "<string>", time.perf_counter() - trace.template_started))
+        trace.template_started = None
+
+
+@app.before_request
+def _profile_begin():
+    profiler.begin_request(request.method, request.path, request.endpoint)
+
+
+@app.after_request
+def _profile_end(response):
+    profiler.end_request(response.status_code)
+    return response
+
+
+@app.teardown_request
+def _profile_teardown(error=None):
+    # Only reached with a live trace when the request failed before after_request
+    profiler.end_request(500)
+
+
+# ============================================================================
+# LOGGING
+# ============================================================================
+
+class RotatingLogFile:
+    def __init__(self, path, max_bytes, rotate_seconds, backup_count):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self._open()
+
+    def _open(self):
+        self.stream = open(self.path, 'ab')
+        self.size = self.stream.tell()
+        self.opened = time.time()
+
+    def _should_rotate(self, incoming):
+        if self.size == 0:
+            return False
+        if self.max_bytes and self.size + incoming > self.max_bytes:
+            return True
+        return bool(self.rotate_seconds) and time.time() - self.opened >= self.rotate_seconds
+
+    def rotate(self):
+        self.stream.close()
+        os.replace(self.path, f"{self.path}.{datetime.now():%Y%m%d-%H%M%S-%f}")
+        backups = sorted(glob.glob(f"{glob.escape(self.path)}.*"))
+        for old in backups[:max(0, len(backups) - self.backup_count)]:
+            os.remove(old)
+        self._open()
+
+    def write(self, data):
+        if self._should_rotate(len(data)):
+            self.rotate()
+        self.stream.write(data)
+        self.stream.flush()
+        self.size += len(data)
+
+    def close(self):
+        self.stream.close()
+
+
+class AsyncLogWriter:
+    _STOP = object()
+
+    def __init__(self, directory, streams, queue_size, batch_size, flush_interval,
+                 max_bytes, rotate_seconds, backup_count):
+        os.makedirs(directory, exist_ok=True)
+        # Each worker process writes and rotates its own files; sharing one would
+        # let two rotations race over the same path
+        pid = os.getpid()
+        self.files = {
+            stream: RotatingLogFile(os.path.join(directory, f"{stream}.{pid}.log"),
+                                    max_bytes, rotate_seconds, backup_count)
+            for stream in streams
+        }
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = Counter()
+        self._dropped_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, stream, record):
+        # Never blocks the request: a full queue drops the record and counts it
+        try:
+            self.queue.put_nowait((stream, record))
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped[stream] += 1
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not self._STOP:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            stopping = batch[-1] is self._STOP
+            if stopping:
+                batch.pop()
+
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, Counter()
+            for stream, count in dropped.items():
+                batch.append((stream, {"ts": _log_timestamp(), "event": "log_dropped", "count": count}))
+
+            lines = {}
+            for stream, record in batch:
+                lines.setdefault(stream, []).append(json.dumps(record, ensure_ascii=False, default=str))
+            for stream, records in lines.items():
+                try:
+                    self.files[stream].write(("\n".join(records) + "\n").encode('utf-8'))
+                except OSError as e:
+                    app.logger.warning("Cannot write %s log: %s", stream, e)
+
+            if stopping:
+                for log_file in self.files.values():
+                    log_file.close()
+                return
+
+    def close(self, timeout=5):
+        try:
+            self.queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+def _log_timestamp():
+    return datetime.now().isoformat(timespec='milliseconds')
+
+
+event_log = AsyncLogWriter(
+    LOG_DIR, ("access", "audit"), LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL,
+    LOG_MAX_BYTES, LOG_ROTATE_SECONDS, LOG_BACKUP_COUNT
+) if LOG_DIR else None
+
+if event_log is not None:
+    atexit.register(event_log.close)
+
+
+def audit(event, **fields):
+    if event_log is None:
+        return
+    record = {"ts": _log_timestamp(), "event": event}
+    if has_request_context():
+        record["ip"] = request.remote_addr
+        if 'tenant' in g:
+            record["tenant"] = g.tenant.id
+        if 'admin' in g:
+            record["admin"] = g.admin["username"]
+    record.update(fields)
+    event_log.emit("audit", record)
+
+
+@app.before_request
+def _log_begin():
+    g.log_started = time.perf_counter()
+
+
+@app.after_request
+def _log_access(response):
+    if event_log is not None:
+        event_log.emit("access", {
+            "ts": _log_timestamp(),
+            "tenant": g.tenant.id if 'tenant' in g else None,
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+            "duration_ms": round((time.perf_counter() - g.get('log_started', time.perf_counter())) * 1000, 2),
+            "ip": request.remote_addr,
+            "user_agent": request.user_agent.string
+        })
+    return response
+
+
+# ============================================================================
+# ADMIN AUTH
+# ============================================================================
+
+class AuthStore:
+    # The state backend when nodes share one, otherwise a table in the local DB
+    # that all worker processes see
+    def get(self, key):
+        if state_backend is not None:
+            data = state_backend.get(key)
+            return json.loads(data) if data else None
+
+        conn = _connect()
+        try:
+            row = conn.execute("SELECT value FROM admin_auth WHERE key=? AND expires_at > ?",
+                               (key, time.time())).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        if state_backend is not None:
+            state_backend.set(key, json.dumps(value), ttl=ttl)
+            return
+
+        conn = _connect()
+        try:
+            conn.execute("DELETE FROM admin_auth WHERE expires_at <= ?", (time.time(),))
+            conn.execute("INSERT OR REPLACE INTO admin_auth (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(value), time.time() + ttl))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete(self, key):
+        if state_backend is not None:
+            state_backend.delete(key)
+            return
+
+        conn = _connect()
+        try:
+            conn.execute("DELETE FROM admin_auth WHERE key=?", (key,))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+auth_store = AuthStore()
+
+# Key derivation is deliberately slow: only a few run at once and a short queue
+# waits for them, everything beyond that is turned away instead of piling up
+_hash_executor = ThreadPoolExecutor(max_workers=ADMIN_HASH_WORKERS, thread_name_prefix="admin-hash")
+_hash_slots = threading.BoundedSemaphore(ADMIN_HASH_WORKERS + ADMIN_HASH_QUEUE)
+
+
+def _verify_admin_password(password_hash, password):
+    if not _hash_slots.acquire(blocking=False):
+        return None
+    try:
+        return _hash_executor.submit(check_password_hash, password_hash, password).result()
+    finally:
+        _hash_slots.release()
+
+
+def _login_keys(tenant_id, ip, username):
+    return ((f"admin_login:ip:{ip}", ADMIN_LOGIN_IP_MAX_FAILURES),
+            (f"admin_login:user:{tenant_id}:{username}", ADMIN_LOGIN_MAX_FAILURES))
+
+
+def _login_lockout(keys):
+    now = time.time()
+    waits = [record["locked_until"] - now for record in map(auth_store.get, (key for key, _ in keys))
+             if record and record["locked_until"] > now]
+    return max(waits, default=0)
+
+
+def _record_login_failure(keys):
+    for key, limit in keys:
+        record = auth_store.get(key) or {"failures": 0, "locked_until": 0}
+        record["failures"] += 1
+        if record["failures"] >= limit:
+            record.update(failures=0, locked_until=time.time() + ADMIN_LOGIN_LOCKOUT)
+            auth_store.set(key, record, ADMIN_LOGIN_LOCKOUT)
+            audit("admin_login_locked", key=key)
+        else:
+            auth_store.set(key, record, ADMIN_LOGIN_WINDOW)
+
+
+def _admin_session_key(token):
+    # Only a digest of the token is stored, so a leaked store does not leak sessions
+    return "admin_session:" + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def create_admin_session(tenant_id, username):
+    token = secrets.token_urlsafe(32)
+    auth_store.set(_admin_session_key(token), {
+        "tenant": tenant_id,
+        "username": username,
+        "created": time.time(),
+        "ip": request.remote_addr
+    }, ADMIN_SESSION_TTL)
+    return token
+
+
+def load_admin_session(token, tenant_id):
+    if not token:
+        return None
+    record = auth_store.get(_admin_session_key(token))
+    if not record or record["tenant"] != tenant_id:
+        return None
+    revoked_before = auth_store.get(f"admin_revoked_before:{tenant_id}")
+    if revoked_before and record["created"] <= revoked_before:
+        return None
+    return record
+
+
+def revoke_admin_session(token):
+    auth_store.delete(_admin_session_key(token))
+
+
+def revoke_all_admin_sessions(tenant_id):
+    # Sessions created before the mark are rejected; it outlives every one of them
+    auth_store.set(f"admin_revoked_before:{tenant_id}", time.time(), ADMIN_SESSION_TTL)
+
+
 # ============================================================================
 # DECORATORS & HELPERS
 # ============================================================================
@@ -66,122 +1798,575 @@ def init_db():
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not session.get('admin_logged_in'):
+        # Admin sessions are bound to the storefront they were opened on
+        record = load_admin_session(session.get('admin_token'), g.tenant.id)
+        if record is None:
             return redirect('/admin/login')
+        g.admin = record
         return f(*args, **kwargs)
     return decorated_function
 
 
-def _validate_region_country(region_id, country_id):
-    return region_id in PROXIES and country_id in PROXIES[region_id]["countries"]
+def operator_required(f):
+    # Process-wide tools see every storefront's requests, so only the default storefront's admin gets them
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if g.tenant.id != DEFAULT_TENANT_ID:
+            abort(404)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def _validate_region_country(region_id, country_id, proxies=None):
+    if proxies is None:
+        proxies = g.tenant.catalog.proxies
+    return region_id in proxies and country_id in proxies[region_id]["countries"]
 
 
 def _get_country_name(region_id, country_id):
-    if _validate_region_country(region_id, country_id):
-        return PROXIES[region_id]["countries"][country_id]["name"]
+    proxies = g.tenant.catalog.proxies
+    if _validate_region_country(region_id, country_id, proxies):
+        return proxies[region_id]["countries"][country_id]["name"]
     return "Неизвестная страна"
 
 
-def _generate_proxy_data(quantity):
+def _admin_result(text, category):
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(message=text, category=category)
+    session['admin_message'] = (text, category)
+    return redirect('/admin')
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+def _payment_filters(args):
+    clauses, params = ["tenant_id = ?"], [g.tenant.id]
+
+    # Support staff often quote only the digits of the payment comment
+    query = args.get('q', '').strip()
+    if query:
+        prefix = f"proxy_{query}" if query.isdigit() else query
+        clauses.append("payment_id >= ? AND payment_id < ?")
+        params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+    try:
+        amount = float(args.get('amount', ''))
+    except ValueError:
+        amount = None
+    if amount is not None:
+        clauses.append("amount = ?")
+        params.append(amount)
+
+    country = args.get('country')
+    if country:
+        clauses.append("country_id = ?")
+        params.append(country)
+
+    status = args.get('status')
+    if status:
+        clauses.append("status = ?")
+        params.append(status)
+
+    date_from = _parse_date(args.get('date_from'))
+    if date_from:
+        clauses.append("timestamp >= ?")
+        params.append(date_from)
+
+    date_to = _parse_date(args.get('date_to'))
+    # The last representable day has no next day to compare against, nothing is later anyway
+    if date_to and date_to.date() < datetime.max.date():
+        clauses.append("timestamp < ?")
+        params.append(date_to + timedelta(days=1))
+
+    return f"WHERE {' AND '.join(clauses)}", params
+
+
+# ============================================================================
+# CREDENTIALS
+# ============================================================================
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    # The filter lives in one process, so the per-process salted hash() is enough
+    def _positions(self, key):
+        h1 = hash(key)
+        h2 = hash((key, self.size)) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        # Stops at the first clear bit, which is almost always the first probe for new keys
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class IssuedCredentials:
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._filter = None
+
+    def _load(self):
+        # Every credential adds two keys: its login and its ip:port
+        bloom = BloomFilter(2 * self._capacity)
+        conn = _connect_readonly()
+        try:
+            for login, ip, port in conn.execute("SELECT login, ip, port FROM payment_credentials"):
+                bloom.add(login)
+                bloom.add(f"{ip}:{port}")
+        finally:
+            conn.close()
+        return bloom
+
+    def filter(self):
+        with self._lock:
+            if self._filter is None:
+                self._filter = self._load()
+            return self._filter
+
+    def add(self, proxies_data):
+        bloom = self.filter()
+        with self._lock:
+            for proxy in proxies_data:
+                bloom.add(proxy["login"])
+                bloom.add(f"{proxy['ip']}:{proxy['port']}")
+
+    def preload(self):
+        # Warm the filter off the request path so the first confirm does not pay for the scan
+        threading.Thread(target=self.filter, name="credentials-filter", daemon=True).start()
+
+
+issued_credentials = IssuedCredentials(CREDENTIALS_BLOOM_CAPACITY)
+
+# ip (4) + port (2) + login (5 bytes -> 8 base32 chars) + password (9 bytes -> 12 base64 chars)
+CREDENTIAL_RECORD_BYTES = 20
+
+
+def _draw_credentials(count):
+    buffer = secrets.token_bytes(count * CREDENTIAL_RECORD_BYTES)
+    ips = buffer[:4 * count]
+    ports = struct.unpack(f">{count}H", buffer[4 * count:6 * count])
+    # Field widths are multiples of the encodings' block sizes, so one encode call covers the whole batch
+    logins = base64.b32encode(buffer[6 * count:11 * count]).decode().lower()
+    passwords = base64.urlsafe_b64encode(buffer[11 * count:]).decode()
+
+    octets = iter(ips)
     return [
         {
-            "ip": ".".join(str(random.randint(0, 255)) for _ in range(4)),
-            "port": random.randint(1000, 9999),
-            "login": f"user{random.randint(1000, 9999)}",
-            "password": f"pass{random.randint(10000, 99999)}"
+            "ip": f"{a}.{b}.{c}.{d}",
+            "port": 1000 + port % 9000,
+            "login": f"user{logins[8 * i:8 * i + 8]}",
+            "password": passwords[12 * i:12 * i + 12]
         }
-        for _ in range(quantity)
+        for i, (a, b, c, d), port in zip(range(count), zip(octets, octets, octets, octets), ports)
     ]
 
 
+def _generate_proxy_data(quantity):
+    issued = issued_credentials.filter()
+    seen = set()
+    proxies_data = []
+
+    while len(proxies_data) < quantity:
+        for proxy in _draw_credentials(quantity - len(proxies_data)):
+            login, endpoint = proxy["login"], f"{proxy['ip']}:{proxy['port']}"
+            if login in seen or endpoint in seen or login in issued or endpoint in issued:
+                continue
+            seen.add(login)
+            seen.add(endpoint)
+            proxies_data.append(proxy)
+
+    return proxies_data
+
+
+def _issue_credentials(conn, payment_id, quantity, attempts=3):
+    # The filter only knows this process' issues; the unique indexes catch the rest
+    for attempt in range(attempts):
+        proxies_data = _generate_proxy_data(quantity)
+        try:
+            _store_credentials(conn, payment_id, proxies_data)
+        except sqlite3.IntegrityError:
+            if attempt == attempts - 1:
+                raise
+            continue
+        issued_credentials.add(proxies_data)
+        return proxies_data
+
+
 # ============================================================================
-# PROXIES DATA
+# RESULT CACHE
 # ============================================================================
 
-PROXIES = {
-    "europe": {
-        "name": "Европа",
-        "countries": {
-            "austria": {"name": "Австрия", "price": 249, "color": "#4AA896"},
-            "bosnia": {"name": "Босния и Герцеговина", "price": 249, "color": "#4AA896"},
-            "uk": {"name": "Великобритания", "price": 299, "color": "#4AA896"},
-            "hungary": {"name": "Венгрия", "price": 249, "color": "#4AA896"},
-            "germany": {"name": "Германия", "price": 299, "color": "#4AA896"},
-            "greece": {"name": "Греция", "price": 199, "color": "#4AA896"},
-            "denmark": {"name": "Дания", "price": 249, "color": "#4AA896"},
-            "ireland": {"name": "Ирландия", "price": 299, "color": "#4AA896"},
-            "iceland": {"name": "Исландия", "price": 249, "color": "#4AA896"},
-            "spain": {"name": "Испания", "price": 299, "color": "#4AA896"},
-            "italy": {"name": "Италия", "price": 299, "color": "#4AA896"},
-            "latvia": {"name": "Латвия", "price": 299, "color": "#4AA896"},
-            "netherlands": {"name": "Нидерланды", "price": 149, "color": "#4AA896"},
-            "norway": {"name": "Норвегия", "price": 249, "color": "#4AA896"},
-            "poland": {"name": "Польша", "price": 149, "color": "#4AA896"},
-            "portugal": {"name": "Португалия", "price": 299, "color": "#4AA896"},
-            "russia": {"name": "Россия", "price": 99, "color": "#4AA896"},
-            "serbia": {"name": "Сербия", "price": 199, "color": "#4AA896"},
-            "slovakia": {"name": "Словакия", "price": 199, "color": "#4AA896"},
-            "slovenia": {"name": "Словения", "price": 199, "color": "#4AA896"},
-            "finland": {"name": "Финляндия", "price": 199, "color": "#4AA896"},
-            "france": {"name": "Франция", "price": 299, "color": "#4AA896"},
-            "croatia": {"name": "Хорватия", "price": 249, "color": "#4AA896"},
-            "czech": {"name": "Чехия", "price": 249, "color": "#4AA896"},
-            "switzerland": {"name": "Швейцария", "price": 249, "color": "#4AA896"},
-            "sweden": {"name": "Швеция", "price": 249, "color": "#4AA896"},
-            "estonia": {"name": "Эстония", "price": 199, "color": "#4AA896"},
-        }
-    },
-    "asia": {
-        "name": "Азия",
-        "countries": {
-            "azerbaijan": {"name": "Азербайджан", "price": 149, "color": "#4AA896"},
-            "vietnam": {"name": "Вьетнам", "price": 149, "color": "#4AA896"},
-            "hongkong": {"name": "Гонконг", "price": 199, "color": "#4AA896"},
-            "georgia": {"name": "Грузия", "price": 199, "color": "#4AA896"},
-            "israel": {"name": "Израиль", "price": 249, "color": "#4AA896"},
-            "india": {"name": "Индия", "price": 249, "color": "#4AA896"},
-            "indonesia": {"name": "Индонезия", "price": 199, "color": "#4AA896"},
-            "kazakhstan": {"name": "Казахстан", "price": 149, "color": "#4AA896"},
-            "qatar": {"name": "Катар", "price": 199, "color": "#4AA896"},
-            "china": {"name": "Китай", "price": 149, "color": "#4AA896"},
-            "kuwait": {"name": "Кувейт", "price": 299, "color": "#4AA896"},
-            "malaysia": {"name": "Малайзия", "price": 249, "color": "#4AA896"},
-            "uae": {"name": "ОАЭ", "price": 249, "color": "#4AA896"},
-            "korea": {"name": "Республика Корея", "price": 299, "color": "#4AA896"},
-            "thailand": {"name": "Таиланд", "price": 299, "color": "#4AA896"},
-            "turkey": {"name": "Турция", "price": 149, "color": "#4AA896"},
-            "philippines": {"name": "Филиппины", "price": 299, "color": "#4AA896"},
-            "japan": {"name": "Япония", "price": 299, "color": "#4AA896"},
-        }
-    },
-    "america": {
-        "name": "Америка",
-        "countries": {
-            "argentina": {"name": "Аргентина", "price": 299, "color": "#4AA896"},
-            "brazil": {"name": "Бразилия", "price": 199, "color": "#4AA896"},
-            "canada": {"name": "Канада", "price": 149, "color": "#4AA896"},
-            "cuba": {"name": "Куба", "price": 249, "color": "#4AA896"},
-            "mexico": {"name": "Мексика", "price": 199, "color": "#4AA896"},
-            "usa": {"name": "США", "price": 149, "color": "#4AA896"},
-        }
-    },
-    "africa": {
-        "name": "Африка",
-        "countries": {
-            "egypt": {"name": "Египет", "price": 149, "color": "#4AA896"},
-            "morocco": {"name": "Марокко", "price": 199, "color": "#4AA896"},
-            "southafrica": {"name": "ЮАР", "price": 249, "color": "#4AA896"},
-        }
-    },
-    "oceania": {
-        "name": "Океания",
-        "countries": {
-            "australia": {"name": "Австралия", "price": 249, "color": "#4AA896"},
-            "newzealand": {"name": "Новая Зеландия", "price": 199, "color": "#4AA896"},
-            "samoa": {"name": "Самоа", "price": 199, "color": "#4AA896"},
+class SingleFlight:
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self._calls = {}
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            now = time.monotonic()
+            # Same TTL for every entry, so the oldest insert is always the first to expire
+            while self._recent and next(iter(self._recent.values()))[0] <= now:
+                self._recent.popitem(last=False)
+            if key in self._recent:
+                return self._recent[key][1]
+
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None and self.ttl > 0:
+                    self._recent.pop(key, None)
+                    self._recent[key] = (time.monotonic() + self.ttl, call.result)
+            call.done.set()
+        return call.result
+
+    def forget(self, key):
+        with self._lock:
+            self._recent.pop(key, None)
+
+
+# Concurrent identical lookups in this process share one query or render;
+# payment statuses are additionally reused for PAYMENT_LOOKUP_TTL seconds
+payment_lookups = SingleFlight(PAYMENT_LOOKUP_TTL)
+inflight = SingleFlight()
+
+
+class RenderedPageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.version = 0
+        self._entries = OrderedDict()
+        self._keys_by_payment = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body, version):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            # Skip pages rendered from a read that raced with an invalidation
+            if version != self.version:
+                return
+            self._remove(key)
+            self._entries[key] = body
+            self.size += len(body)
+            self._keys_by_payment.setdefault(key[0], set()).add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        body = self._entries.pop(key, None)
+        if body is None:
+            return
+        self.size -= len(body)
+        keys = self._keys_by_payment.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_payment[key[0]]
+
+    def invalidate(self, payment_id):
+        with self._lock:
+            self.version += 1
+            for key in list(self._keys_by_payment.get(payment_id, ())):
+                self._remove(key)
+
+
+# Completed orders never change, so their rendered pages are kept per process
+# until the payment is deleted here or evicted by size
+success_pages = RenderedPageCache(SUCCESS_PAGE_CACHE_BYTES)
+
+
+# ============================================================================
+# CATALOG
+# ============================================================================
+
+class CatalogError(ValueError):
+    pass
+
+
+def _validate_catalog(proxies):
+    if not isinstance(proxies, dict) or not proxies:
+        raise CatalogError("catalog must be a non-empty object of regions")
+
+    for region_id, region in proxies.items():
+        if not SLUG_RE.fullmatch(region_id):
+            raise CatalogError(f"invalid region id '{region_id}'")
+        if not isinstance(region, dict) or not isinstance(region.get("name"), str) \
+                or not isinstance(region.get("countries"), dict):
+            raise CatalogError(f"region '{region_id}' needs a name and a countries object")
+        if MARKUP_RE.search(region["name"]):
+            raise CatalogError(f"region '{region_id}' name contains markup characters")
+
+        for country_id, country in region["countries"].items():
+            where = f"{region_id}/{country_id}"
+            if not SLUG_RE.fullmatch(country_id):
+                raise CatalogError(f"invalid country id '{where}'")
+            if not isinstance(country, dict) or not isinstance(country.get("name"), str):
+                raise CatalogError(f"country '{where}' needs a name")
+            # Names end up in admin rows built as HTML, keep them plain text
+            if MARKUP_RE.search(country["name"]):
+                raise CatalogError(f"country '{where}' name contains markup characters")
+            price = country.get("price")
+            if isinstance(price, bool) or not isinstance(price, (int, float)) or price <= 0:
+                raise CatalogError(f"country '{where}' has an invalid price")
+            if not COLOR_RE.fullmatch(str(country.get("color", ""))):
+                raise CatalogError(f"country '{where}' has an invalid color")
+
+
+class Catalog:
+    def __init__(self, proxies, mtime=None):
+        _validate_catalog(proxies)
+        self.proxies = proxies
+        self.mtime = mtime
+        self.digest = json.dumps(proxies, sort_keys=True)
+        self.fingerprints = {
+            (region_id, country_id): json.dumps(country, sort_keys=True)
+            for region_id, region in proxies.items()
+            for country_id, country in region["countries"].items()
         }
-    }
-}
+
+    def changed_countries(self, other):
+        keys = self.fingerprints.keys() | other.fingerprints.keys()
+        return {key for key in keys if self.fingerprints.get(key) != other.fingerprints.get(key)}
+
+
+def _read_config_file(path, error):
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    try:
+        if path.endswith('.toml'):
+            if tomllib is None:
+                raise error("TOML files require Python 3.11+")
+            return tomllib.loads(raw.decode('utf-8'))
+        return json.loads(raw)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise error(f"cannot parse {path}: {e}") from e
+
+
+def load_catalog(path):
+    mtime = os.stat(path).st_mtime_ns
+    return Catalog(_read_config_file(path, CatalogError), mtime)
+
+
+def swap_catalog(tenant, new_catalog):
+    with tenant.lock:
+        old_catalog, tenant.catalog = tenant.catalog, new_catalog
+        changed = new_catalog.changed_countries(old_catalog)
+        for region_id, country_id in changed:
+            tenant.pages.pop(("proxy", region_id, country_id), None)
+        if new_catalog.digest != old_catalog.digest:
+            tenant.pages.pop(("proxies",), None)
+    return changed
+
+
+def _cached_page(tenant, snapshot, key, render):
+    year = datetime.now().year
+    entry = tenant.pages.get(key)
+    if entry and entry[0] == year:
+        return entry[1]
+
+    def build():
+        page = render()
+        with tenant.lock:
+            # A page rendered from a catalog that was swapped out meanwhile is served once but not kept
+            if snapshot is tenant.catalog:
+                tenant.pages[key] = (year, page)
+        return page
+
+    return inflight.do((tenant.id, key, year, id(snapshot)), build)
+
+
+def _watch_catalog():
+    seen_mtimes = {tenant.id: tenant.catalog.mtime for tenant in tenants}
+    while True:
+        time.sleep(CATALOG_POLL_INTERVAL)
+        for tenant in tenants:
+            try:
+                mtime = os.stat(tenant.catalog_path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime == seen_mtimes[tenant.id]:
+                continue
+
+            seen_mtimes[tenant.id] = mtime
+            try:
+                swap_catalog(tenant, load_catalog(tenant.catalog_path))
+            except (OSError, CatalogError) as e:
+                app.logger.warning("Catalog reload for %s failed, keeping the current version: %s", tenant.id, e)
+
+
+def start_catalog_watcher():
+    threading.Thread(target=_watch_catalog, name="catalog-watcher", daemon=True).start()
+
+
+# ============================================================================
+# TENANTS
+# ============================================================================
+
+class TenantError(ValueError):
+    pass
+
+
+THEME_VARIABLES = {"mint-dark", "mint-medium", "mint-light", "mint-extra-light", "mint-super-light",
+                   "text-dark", "text-light", "gray"}
+
+
+class Tenant:
+    def __init__(self, tenant_id, catalog_path, bank_card, admin_username, admin_password_hash,
+                 hosts=(), brand="MintProxy", contact_email="mintproxy@tutamail.com", theme=None):
+        self.id = tenant_id
+        self.hosts = tuple(hosts)
+        self.catalog_path = catalog_path
+        self.catalog = load_catalog(catalog_path)
+        self.bank_card = bank_card
+        self.admin_username = admin_username
+        self.admin_password_hash = admin_password_hash
+        self.brand = brand
+        self.contact_email = contact_email
+        self.theme = theme or {}
+        # Catalog pages rendered for this storefront only
+        self.pages = {}
+        self.lock = threading.Lock()
+
+
+class TenantRegistry:
+    def __init__(self, tenants, fallback=None):
+        self._tenants = list(tenants)
+        self._by_host = {host: tenant for tenant in self._tenants for host in tenant.hosts}
+        self.fallback = fallback
+
+    def __iter__(self):
+        return iter(self._tenants)
+
+    def resolve(self, host):
+        return self._by_host.get(host.rsplit(':', 1)[0].lower(), self.fallback)
+
+
+def _build_tenant(tenant_id, entry, base_dir):
+    if not SLUG_RE.fullmatch(tenant_id):
+        raise TenantError(f"invalid tenant id {tenant_id!r}")
+    if not isinstance(entry, dict):
+        raise TenantError(f"{tenant_id}: tenant must be an object")
+
+    hosts = entry.get("hosts", [])
+    if not isinstance(hosts, list) or not all(isinstance(host, str) and host for host in hosts):
+        raise TenantError(f"{tenant_id}: hosts must be a list of host names")
+    if not CARD_RE.fullmatch(str(entry.get("bank_card", ""))):
+        raise TenantError(f"{tenant_id}: bank_card must be 12-23 digits and spaces")
+    for field in ("admin_username", "admin_password_hash"):
+        if not isinstance(entry.get(field), str) or not entry[field]:
+            raise TenantError(f"{tenant_id}: {field} is required")
+
+    theme = entry.get("theme", {})
+    if not isinstance(theme, dict):
+        raise TenantError(f"{tenant_id}: theme must be an object")
+    for name, value in theme.items():
+        if name not in THEME_VARIABLES or not COLOR_RE.fullmatch(str(value)):
+            raise TenantError(f"{tenant_id}: bad theme color {name}={value!r}")
+
+    try:
+        return Tenant(
+            tenant_id,
+            os.path.join(base_dir, entry.get("catalog", "catalog.json")),
+            entry["bank_card"],
+            entry["admin_username"],
+            entry["admin_password_hash"],
+            hosts=[host.lower() for host in hosts],
+            brand=str(entry.get("brand", "MintProxy")),
+            contact_email=str(entry.get("contact_email", "mintproxy@tutamail.com")),
+            theme=theme
+        )
+    except (OSError, CatalogError) as e:
+        raise TenantError(f"{tenant_id}: {e}") from e
+
+
+def load_tenants(path):
+    data = _read_config_file(path, TenantError)
+    if not isinstance(data, dict) or not data:
+        raise TenantError("tenant registry must be a non-empty object of tenants")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    built = [_build_tenant(tenant_id, entry, base_dir) for tenant_id, entry in data.items()]
+
+    hosts = [host for tenant in built for host in tenant.hosts]
+    duplicates = {host for host in hosts if hosts.count(host) > 1}
+    if duplicates:
+        raise TenantError(f"hosts served by several tenants: {', '.join(sorted(duplicates))}")
+
+    fallback = [tenant for tenant in built if data[tenant.id].get("fallback")]
+    if len(fallback) > 1:
+        raise TenantError("only one tenant can be the fallback")
+    return TenantRegistry(built, fallback[0] if fallback else None)
+
+
+if TENANTS_PATH:
+    tenants = load_tenants(TENANTS_PATH)
+else:
+    _default_tenant = Tenant(DEFAULT_TENANT_ID, CATALOG_PATH, BANK_CARD, ADMIN_USERNAME, ADMIN_PASSWORD_HASH)
+    tenants = TenantRegistry([_default_tenant], fallback=_default_tenant)
+
+
+@app.before_request
+def _resolve_tenant():
+    tenant = tenants.resolve(request.host)
+    if tenant is None:
+        return "Неизвестный магазин", 404
+    g.tenant = tenant
+
+
+@app.context_processor
+def _tenant_context():
+    return {"tenant": g.get('tenant') or tenants.fallback}
+
 
 BASE_HTML = """
 <!DOCTYPE html>
@@ -189,7 +2374,7 @@ BASE_HTML = """
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{title} | MintProxy</title>
+    <title>{title} | {{{{ tenant.brand }}}}</title>
     <style>
         @keyframes slideUp {{
             0% {{ transform: translateY(50px); opacity: 0; }}
@@ -205,6 +2390,8 @@ BASE_HTML = """
             --text-dark: #2E3E4C;
             --text-light: #FFFFFF;
             --gray: #F5F7FA;
+            {{% if tenant %}}{{% for name, value in tenant.theme.items() %}}--{{{{ name }}}}: {{{{ value }}}};
+            {{% endfor %}}{{% endif %}}
         }}
 
         * {{
@@ -337,13 +2524,13 @@ BASE_HTML = """
 <body>
     <nav class="navbar">
         <div class="nav-container">
-            <a href="/" class="logo">MintProxy</a>
+            <a href="/" class="logo">{{{{ tenant.brand }}}}</a>
             <div class="nav-links">
                 <a href="/proxies" class="nav-link">Прокси</a>
                 <div class="contacts-dropdown">
                     <a href="#" class="nav-link" onclick="return false;">Контакты</a>
                     <div class="contacts-dropdown-content">
-                        <p><strong>Email:</strong> mintproxy@tutamail.com</p>
+                        {{% if tenant.contact_email %}}<p><strong>Email:</strong> {{{{ tenant.contact_email }}}}</p>{{% endif %}}
                     </div>
                 </div>
             </div>
@@ -354,7 +2541,7 @@ BASE_HTML = """
 
     <footer id="contacts">
         <div class="container">
-            <p>&copy; {year} MintProxy. Все права защищены.</p>
+            <p>&copy; {year} {{{{ tenant.brand }}}}. Все права защищены.</p>
         </div>
     </footer>
 </body>
@@ -481,9 +2668,16 @@ PROXY_DETAIL_HTML = """
                 </p>
             </div>
 
+            {% if downloadable %}
+            <div style="margin-bottom: 30px; display: flex; justify-content: center; gap: 15px;">
+                <a href="/check_payment/credentials.txt" class="btn">Скачать TXT</a>
+                <a href="/check_payment/credentials.csv" class="btn">Скачать CSV</a>
+            </div>
+            {% endif %}
+
             {% for proxy in proxies_data %}
             <div style="margin-bottom: 40px; padding: 20px; background-color: var(--mint-super-light); border-radius: 8px;">
-                <h3 style="font-size: 1.4rem; margin-bottom: 20px; color: var(--mint-dark);">Прокси #{{ loop.index }}</h3>
+                <h3 style="font-size: 1.4rem; margin-bottom: 20px; color: var(--mint-dark);">Прокси #{{ offset + loop.index }}</h3>
 
                 <div style="text-align: left; margin-bottom: 15px;">
                     <p style="font-weight: 600; margin-bottom: 5px;">Страна:</p>
@@ -527,6 +2721,14 @@ PROXY_DETAIL_HTML = """
             </div>
             {% endfor %}
 
+            {% if pages > 1 %}
+            <div style="margin-bottom: 30px; display: flex; justify-content: center; align-items: center; gap: 15px;">
+                {% if page > 1 %}<a href="/check_payment?page={{ page - 1 }}" class="btn">&larr;</a>{% endif %}
+                <span>Страница {{ page }} из {{ pages }}</span>
+                {% if page < pages %}<a href="/check_payment?page={{ page + 1 }}" class="btn">&rarr;</a>{% endif %}
+            </div>
+            {% endif %}
+
             <div style="margin-bottom: 30px; padding: 20px; background-color: var(--mint-super-light); border-radius: 8px;">
                 <p style="margin-bottom: 10px;"><strong>Количество прокси:</strong> {{ quantity }}</p>
                 <p style="margin-bottom: 10px;"><strong>Срок действия:</strong> 30 дней</p>
@@ -561,6 +2763,88 @@ PROXY_DETAIL_HTML = """
 """
 
 
+ADMIN_SEARCH_HTML = """
+<form action="/admin/search" method="GET" style="display: flex; flex-wrap: wrap; gap: 10px; margin-bottom: 20px; background: var(--text-light); padding: 15px; border-radius: 12px;">
+    <input type="text" name="q" value="{{ args.get('q', '') }}" placeholder="ID платежа"
+           style="flex: 1 1 160px; padding: 8px; border: 1px solid #ddd; border-radius: 6px;">
+    <input type="number" step="0.01" name="amount" value="{{ args.get('amount', '') }}" placeholder="Сумма"
+           style="flex: 0 1 120px; padding: 8px; border: 1px solid #ddd; border-radius: 6px;">
+    <select name="country" style="flex: 0 1 200px; padding: 8px; border: 1px solid #ddd; border-radius: 6px;">
+        <option value="">Все страны</option>
+        {% for region_id, region in proxies.items() %}
+        <optgroup label="{{ region.name }}">
+            {% for country_id, proxy in region.countries.items() %}
+            <option value="{{ country_id }}" {% if args.get('country') == country_id %}selected{% endif %}>{{ proxy.name }}</option>
+            {% endfor %}
+        </optgroup>
+        {% endfor %}
+    </select>
+    <select name="status" style="flex: 0 1 140px; padding: 8px; border: 1px solid #ddd; border-radius: 6px;">
+        <option value="">Все статусы</option>
+        {% for status in statuses %}
+        <option value="{{ status }}" {% if args.get('status') == status %}selected{% endif %}>{{ status }}</option>
+        {% endfor %}
+    </select>
+    <input type="date" name="date_from" value="{{ args.get('date_from', '') }}"
+           style="padding: 8px; border: 1px solid #ddd; border-radius: 6px;">
+    <input type="date" name="date_to" value="{{ args.get('date_to', '') }}"
+           style="padding: 8px; border: 1px solid #ddd; border-radius: 6px;">
+    <button type="submit" class="btn" style="padding: 8px 20px;">Найти</button>
+</form>
+"""
+
+ADMIN_LIVE_JS = """
+<script>
+(function() {
+    const tbody = document.getElementById('payments-body');
+    const messageBox = document.getElementById('admin-message');
+    let cursor = Number(tbody.dataset.cursor);
+
+    function applyChanges(data) {
+        data.changes.forEach(function(change) {
+            const existing = document.getElementById('payment-' + change.payment_id);
+            if (change.html === null) {
+                if (existing) existing.remove();
+                return;
+            }
+            const holder = document.createElement('tbody');
+            holder.innerHTML = change.html;
+            if (existing) existing.replaceWith(holder.firstElementChild);
+            else tbody.prepend(holder.firstElementChild);
+        });
+        cursor = Math.max(cursor, data.cursor);
+    }
+
+    function showMessage(data) {
+        const color = data.category === 'success' ? '#4CAF50' : '#F44336';
+        messageBox.innerHTML = '<div style="margin-bottom: 20px; padding: 15px; background-color: ' + color + '20; border-left: 4px solid ' + color + '; color: ' + color + ';"></div>';
+        messageBox.firstElementChild.textContent = data.message;
+    }
+
+    if (window.EventSource) {
+        const source = new EventSource('/admin/stream?since=' + cursor);
+        source.addEventListener('changes', function(event) {
+            applyChanges(JSON.parse(event.data));
+        });
+    }
+
+    document.addEventListener('click', function(event) {
+        const link = event.target.closest('a[data-action]');
+        if (!link) return;
+        event.preventDefault();
+        fetch(link.href, {headers: {'Accept': 'application/json'}})
+            .then(function(response) { return response.json(); })
+            .then(showMessage)
+            .then(function() {
+                return fetch('/admin/changes?since=' + cursor, {headers: {'Accept': 'application/json'}});
+            })
+            .then(function(response) { return response.json(); })
+            .then(applyChanges);
+    });
+})();
+</script>
+"""
+
 # ============================================================================
 # ROUTES: PUBLIC
 # ============================================================================
@@ -576,36 +2860,41 @@ def home():
     )
 @app.route('/proxies')
 def proxies():
-    return render_template_string(
+    snapshot = g.tenant.catalog
+    return _cached_page(g.tenant, snapshot, ("proxies",), lambda: render_template_string(
         BASE_HTML.format(
             title="Выбор прокси",
             content=PROXIES_HTML,
             year=datetime.now().year
         ),
-        proxies=PROXIES
-    )
+        proxies=snapshot.proxies
+    ))
 
 @app.route('/proxy/<region_id>/<country_id>')
 def proxy_detail(region_id, country_id):
-    if not _validate_region_country(region_id, country_id):
+    snapshot = g.tenant.catalog
+    if not _validate_region_country(region_id, country_id, snapshot.proxies):
         return redirect('/proxies')
 
-    proxy = PROXIES[region_id]["countries"][country_id]
+    proxy = snapshot.proxies[region_id]["countries"][country_id]
+    return _cached_page(g.tenant, snapshot, ("proxy", region_id, country_id),
+                        lambda: _render_proxy_detail(proxy, region_id, country_id))
+
+
+def _render_proxy_detail(proxy, region_id, country_id):
     quantity_options = [
-        (1, proxy['price']),
-        (2, proxy['price'] * 2),
-        (5, proxy['price'] * 5),
-        (10, proxy['price'] * 10),
-        (20, proxy['price'] * 20)
+        (qty, proxy['price'] * qty)
+        for qty in (1, 2, 5, 10, 20, 50, 100, 500, 1000)
+        if qty <= MAX_ORDER_QUANTITY
     ]
 
     return render_template_string(
         BASE_HTML.format(
-            title=f"{proxy['name']} прокси",
+            title="{{ proxy_name }} прокси",
             content=f'''
             <section style="padding: 80px 0; text-align: center; min-height: calc(100vh - 200px);">
                 <div class="container">
-                    <h2 style="font-size: 2rem; margin-bottom: 20px;">{proxy['name']} прокси</h2>
+                    <h2 style="font-size: 2rem; margin-bottom: 20px;">{{{{ proxy_name }}}} прокси</h2>
                     <div style="max-width: 500px; margin: 0 auto; background: var(--text-light); 
                          padding: 30px; border-radius: 12px; box-shadow: 0 5px 15px rgba(0,0,0,0.1);">
                         <p style="font-size: 1.2rem; margin-bottom: 15px;">Цена: <strong>{proxy['price']}₽</strong> за 1 прокси</p>
@@ -627,23 +2916,44 @@ def proxy_detail(region_id, country_id):
             </section>
             ''',
             year=datetime.now().year
-        )
+        ),
+        proxy_name=proxy['name']
     )
 
 @app.route('/create_payment/<region_id>/<country_id>')
 def create_payment(region_id, country_id):
-    if not _validate_region_country(region_id, country_id):
+    tenant = g.tenant
+    proxies = tenant.catalog.proxies
+    if not _validate_region_country(region_id, country_id, proxies):
         return redirect('/proxies')
 
     try:
-        quantity = max(1, min(20, int(request.args.get('quantity', '1'))))
+        quantity = max(1, min(MAX_ORDER_QUANTITY, int(request.args.get('quantity', '1'))))
     except (ValueError, TypeError):
         quantity = 1
 
-    proxy = PROXIES[region_id]["countries"][country_id]
+    proxy = proxies[region_id]["countries"][country_id]
     total_amount = proxy["price"] * quantity
     payment_id = f"proxy_{random.randint(10000, 99999)}"
 
+    timestamp = datetime.now()
+
+    if state_backend is not None:
+        record = {
+            "payment_id": payment_id,
+            "tenant_id": tenant.id,
+            "region_id": region_id,
+            "country_id": country_id,
+            "amount": total_amount,
+            "quantity": quantity,
+            "status": "pending",
+            "proxy_data": "",
+            "timestamp": timestamp.isoformat(' ')
+        }
+        if not _publish_payment(record, nx=True):
+            return redirect('/proxies')
+        state_backend.sadd("payments:pending", payment_id)
+
     session.update({
         "payment_id": payment_id,
         "region_id": region_id,
@@ -652,20 +2962,23 @@ def create_payment(region_id, country_id):
         "quantity": quantity
     })
 
-    conn = sqlite3.connect('payments.db')
+    conn = _connect()
     c = conn.cursor()
     try:
         c.execute('''
             INSERT INTO payments 
-            (payment_id, region_id, country_id, amount, quantity, status, proxy_data, timestamp) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (payment_id, region_id, country_id, total_amount, quantity, 'pending', '', datetime.now()))
+            (payment_id, tenant_id, region_id, country_id, amount, quantity, status, proxy_data, timestamp) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (payment_id, tenant.id, region_id, country_id, total_amount, quantity, 'pending', '', timestamp))
         conn.commit()
     except sqlite3.Error:
         return redirect('/proxies')
     finally:
         conn.close()
 
+    audit("payment_created", payment_id=payment_id, region_id=region_id, country_id=country_id,
+          amount=total_amount, quantity=quantity)
+
     return render_template_string(
         BASE_HTML.format(
             title="Оплата на карту",
@@ -679,9 +2992,9 @@ def create_payment(region_id, country_id):
                             <p style="font-weight: bold; margin-bottom: 5px;">Номер карты:</p>
                             <div style="display: flex; align-items: center; gap: 10px;">
                                 <div style="background: var(--gray); padding: 10px 15px; border-radius: 6px; flex-grow: 1;">
-                                    {BANK_CARD}
+                                    {tenant.bank_card}
                                 </div>
-                                <button onclick="copyToClipboard('{BANK_CARD}')" 
+                                <button onclick="copyToClipboard('{tenant.bank_card}')" 
                                         style="background: var(--mint-dark); color: white; border: none; border-radius: 6px; padding: 10px 15px; cursor: pointer;">
                                     Копировать
                                 </button>
@@ -727,65 +3040,129 @@ def create_payment(region_id, country_id):
         )
     )
 
+def _fetch_payment(payment_id):
+    return payment_lookups.do(payment_id, lambda: _query_payment(payment_id))
+
+
+def _query_payment(payment_id):
+    if state_backend is not None:
+        record = _load_shared_payment(payment_id)
+        return (record['status'], record['amount'], record['quantity']) if record else None
+
+    conn = _connect()
+    c = conn.cursor()
+    c.execute("SELECT status, amount, quantity FROM payments WHERE payment_id=?", (payment_id,))
+    payment = c.fetchone()
+    conn.close()
+    return payment
+
+
+def _render_credentials(proxies_data, amount, quantity, page=1, pages=1, offset=0, downloadable=False):
+    country_name = _get_country_name(session.get("region_id"), session.get("country_id"))
+
+    return render_template_string(
+        BASE_HTML.format(
+            title="{{ country_name }} прокси",
+            content=PROXY_DETAIL_HTML,
+            year=datetime.now().year
+        ),
+        proxies_data=proxies_data,
+        country_name=country_name,
+        quantity=quantity,
+        total_amount=amount,
+        page=page,
+        pages=pages,
+        offset=offset,
+        downloadable=downloadable
+    )
+
+
+def _read_credentials_page(payment_id, offset):
+    conn = _connect_readonly()
+    try:
+        return _load_credentials(conn, payment_id, offset, CREDENTIALS_PAGE_SIZE)
+    finally:
+        conn.close()
+
+
 @app.route('/check_payment')
 def check_payment():
     payment_id = session.get("payment_id")
     if not payment_id:
         return redirect('/proxies')
 
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
-    c.execute("SELECT status, proxy_data, amount, quantity FROM payments WHERE payment_id=?", (payment_id,))
-    payment = c.fetchone()
-    conn.close()
+    try:
+        requested_page = max(1, int(request.args.get('page', '1')))
+    except ValueError:
+        requested_page = 1
+
+    cache_key = (payment_id, g.tenant.id, requested_page, datetime.now().year)
+    cache_version = success_pages.version
+    payment = _fetch_payment(payment_id)
+
+    # Deletes and refunds in other workers only clear their own cache, so a cached
+    # page is served only while the status (via the lookup micro-cache) is still success
+    if payment and payment[0] == 'success':
+        pages = max(1, -(-payment[2] // CREDENTIALS_PAGE_SIZE))
+        # Out-of-range pages must not each become a cache entry
+        if requested_page > pages:
+            return redirect(f'/check_payment?page={pages}')
+        cached = success_pages.get(cache_key)
+        if cached is not None:
+            return Response(cached, mimetype='text/html')
 
     if not payment:
         if 'proxies_data' in session:
-            proxies_data = session['proxies_data']
-            region_id = session.get("region_id")
-            country_id = session.get("country_id")
-            amount = session.get("amount")
-            quantity = session.get("quantity")
-            country_name = _get_country_name(region_id, country_id)
-
-            return render_template_string(
-                BASE_HTML.format(
-                    title=f"{country_name} прокси",
-                    content=PROXY_DETAIL_HTML,
-                    year=datetime.now().year
-                ),
-                proxies_data=proxies_data,
-                country_name=country_name,
-                quantity=quantity,
-                total_amount=amount
+            return _render_credentials(
+                session['proxies_data'],
+                session.get("amount"),
+                session.get("quantity")
             )
         return redirect('/proxies')
 
-    status, proxy_data, amount, quantity = payment
+    status, amount, quantity = payment
 
     if status == 'success':
-        try:
-            proxies_data = json.loads(proxy_data) if proxy_data else []
+        if state_backend is not None:
+            _import_shared_credentials(payment_id)
+
+        page = requested_page
+        offset = (page - 1) * CREDENTIALS_PAGE_SIZE
+
+        proxies_data = inflight.do(("credentials", payment_id, offset),
+                                   lambda: _read_credentials_page(payment_id, offset))
+
+        # Only small orders fit in the session; large ones are always read from the DB
+        if quantity <= CREDENTIALS_PAGE_SIZE:
             session['proxies_data'] = proxies_data
-            session['amount'] = amount
-            session['quantity'] = quantity
-        except (json.JSONDecodeError, ValueError):
-            proxies_data = []
+        session['amount'] = amount
+        session['quantity'] = quantity
 
-        region_id = session.get("region_id")
-        country_id = session.get("country_id")
-        country_name = _get_country_name(region_id, country_id)
+        html = _render_credentials(proxies_data, amount, quantity, page=page, pages=pages, offset=offset,
+                                   downloadable=True)
+        success_pages.put(cache_key, html.encode('utf-8'), cache_version)
+        return html
 
+    if status in PAYMENT_STATUS_MESSAGES:
         return render_template_string(
             BASE_HTML.format(
-                title=f"{country_name} прокси",
-                content=PROXY_DETAIL_HTML,
+                title=PAYMENT_STATUS_MESSAGES[status],
+                content=f'''
+                <section style="padding: 80px 0; text-align: center; min-height: calc(100vh - 200px);">
+                    <div class="container" style="max-width: 600px;">
+                        <div style="background: var(--text-light); padding: 30px; border-radius: 12px; box-shadow: 0 5px 15px rgba(0,0,0,0.1);">
+                            <h2 style="margin-bottom: 20px;">{PAYMENT_STATUS_MESSAGES[status]}</h2>
+                            <div style="background: var(--mint-super-light); padding: 15px; border-radius: 8px; margin-bottom: 30px;">
+                                <p>Номер вашего платежа: <strong>{payment_id}</strong></p>
+                                <p>Сумма: <strong>{amount}₽</strong></p>
+                            </div>
+                            <a href="/proxies" class="btn">К выбору прокси</a>
+                        </div>
+                    </div>
+                </section>
+                ''',
                 year=datetime.now().year
-            ),
-            proxies_data=proxies_data,
-            country_name=country_name,
-            quantity=quantity,
-            total_amount=amount
+            )
         )
 
     return render_template_string(
@@ -820,19 +3197,62 @@ def check_payment():
     )
 
 
+@app.route('/check_payment/credentials.<fmt>')
+def download_credentials(fmt):
+    if fmt not in ('txt', 'csv'):
+        abort(404)
+
+    payment_id = session.get("payment_id")
+    payment = _fetch_payment(payment_id) if payment_id else None
+    if not payment or payment[0] != 'success':
+        return redirect('/check_payment')
+
+    if state_backend is not None:
+        _import_shared_credentials(payment_id)
+
+    batches = _iter_credentials(payment_id)
+    if fmt == 'csv':
+        chunks = _export_csv(batches, ("ip", "port", "login", "password"))
+    else:
+        chunks = ("".join(f"{ip}:{port}:{login}:{password}\n" for ip, port, login, password in rows)
+                  for rows in batches)
+
+    return Response(chunks, mimetype="text/csv" if fmt == 'csv' else "text/plain", headers={
+        'Content-Disposition': f'attachment; filename="{payment_id}.{fmt}"'
+    })
+
+
 # ============================================================================
 # ROUTES: ADMIN
 # ============================================================================
 
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
+    error, status = None, 200
     if request.method == 'POST':
-        username = request.form.get('username', '')
+        username = request.form.get('username', '')[:64]
         password = request.form.get('password', '')
 
-        if username == ADMIN_USERNAME and check_password_hash(ADMIN_PASSWORD_HASH, password):
-            session['admin_logged_in'] = True
-            return redirect('/admin')
+        tenant = g.tenant
+        keys = _login_keys(tenant.id, request.remote_addr, username)
+        # Locked-out attempts are refused before any key derivation
+        wait = _login_lockout(keys)
+        if wait:
+            audit("admin_login_throttled", username=username)
+            error, status = f"Слишком много попыток входа. Повторите через {math.ceil(wait / 60)} мин.", 429
+        else:
+            verified = username == tenant.admin_username and _verify_admin_password(tenant.admin_password_hash, password)
+            if verified:
+                auth_store.delete(keys[1][0])
+                session['admin_token'] = create_admin_session(tenant.id, username)
+                audit("admin_login", username=username)
+                return redirect('/admin')
+            if verified is None:
+                error, status = "Сервер занят, повторите попытку позже.", 503
+            else:
+                _record_login_failure(keys)
+                audit("admin_login_failed", username=username)
+                error, status = "Неверный логин или пароль", 401
 
     return render_template_string(BASE_HTML.format(
         title="Вход в админку",
@@ -840,6 +3260,9 @@ def admin_login():
         <section style="padding: 80px 0; text-align: center; min-height: calc(100vh - 200px);">
             <div class="container" style="max-width: 400px;">
                 <h2 style="margin-bottom: 30px;">Вход в админ-панель</h2>
+                {% if error %}
+                <div style="margin-bottom: 20px; padding: 15px; background-color: #F4433620; border-left: 4px solid #F44336; color: #F44336;">{{ error }}</div>
+                {% endif %}
                 <form method="POST" style="background: var(--text-light); padding: 25px; border-radius: 12px;">
                     <div style="margin-bottom: 20px;">
                         <input type="text" name="username" placeholder="Логин" required 
@@ -855,7 +3278,33 @@ def admin_login():
         </section>
         ''',
         year=datetime.now().year
-    ))
+    ), error=error), status
+
+def _render_payment_row(payment_id, region_id, country_id, amount, quantity, status, timestamp):
+    status_color = PAYMENT_STATUS_COLORS.get(status, "#e74c3c")
+    country_name = _get_country_name(region_id, country_id)
+
+    targets = PAYMENT_TRANSITIONS.get(status, ())
+    action_btn = '✅' if status == "success" else ''
+    for target, action, label, color in (("success", "confirm", "Подтвердить", "var(--mint-dark)"),
+                                         ("cancelled", "cancel", "Отменить", "#95a5a6"),
+                                         ("refunded", "refund", "Возврат", "#f39c12")):
+        if target in targets:
+            action_btn += f'<a href="/admin/{action}/{payment_id}" data-action class="btn" style="padding: 5px 10px; font-size: 0.9rem; margin-right: 5px; background-color: {color};">{label}</a>'
+
+    return f'''<tr id="payment-{payment_id}">
+            <td>{payment_id}</td>
+            <td>{country_name}</td>
+            <td>{amount}₽</td>
+            <td>{quantity}</td>
+            <td style="color: {status_color}">{status}</td>
+            <td>{timestamp}</td>
+            <td style="white-space: nowrap;">
+                {action_btn}
+                <a href="/admin/delete/{payment_id}" data-action class="btn" style="padding: 5px 10px; font-size: 0.9rem; background-color: #e74c3c;">Удалить</a>
+            </td>
+        </tr>'''
+
 
 @app.route('/admin')
 @login_required
@@ -867,31 +3316,23 @@ def admin_panel():
         color = "#4CAF50" if category == "success" else "#F44336"
         message_html = f'''<div style="margin-bottom: 20px; padding: 15px; background-color: {color}20; border-left: 4px solid {color}; color: {color};">{text}</div>'''
 
-    conn = sqlite3.connect('payments.db')
+    if state_backend is not None:
+        conn = _connect()
+        _sync_shared_payments(conn)
+        conn.close()
+
+    # The listing comes from the reporting snapshot; its own change cursor lets
+    # the live queue replay everything written since the snapshot was taken
+    conn = report_snapshot.connect()
     c = conn.cursor()
-    c.execute("SELECT payment_id, region_id, country_id, amount, quantity, status, timestamp FROM payments ORDER BY timestamp DESC")
+    c.execute("SELECT value FROM change_counter WHERE id = 1")
+    cursor = c.fetchone()[0]
+    c.execute("SELECT payment_id, region_id, country_id, amount, quantity, status, timestamp FROM payments "
+              "WHERE tenant_id=? ORDER BY timestamp DESC", (g.tenant.id,))
     payments = c.fetchall()
     conn.close()
 
-    payment_rows = ""
-    for payment_id, region_id, country_id, amount, quantity, status, timestamp in payments:
-        status_color = "#2ecc71" if status == "success" else "#e74c3c"
-        country_name = _get_country_name(region_id, country_id)
-        
-        action_btn = f'<a href="/admin/confirm/{payment_id}" class="btn" style="padding: 5px 10px; font-size: 0.9rem; margin-right: 5px;">Подтвердить</a>' if status != "success" else '✅'
-        
-        payment_rows += f'''<tr>
-            <td>{payment_id}</td>
-            <td>{country_name}</td>
-            <td>{amount}₽</td>
-            <td>{quantity}</td>
-            <td style="color: {status_color}">{status}</td>
-            <td>{timestamp}</td>
-            <td style="white-space: nowrap;">
-                {action_btn}
-                <a href="/admin/delete/{payment_id}" class="btn" style="padding: 5px 10px; font-size: 0.9rem; background-color: #e74c3c;">Удалить</a>
-            </td>
-        </tr>'''
+    payment_rows = "".join(_render_payment_row(*payment) for payment in payments)
 
     return render_template_string(BASE_HTML.format(
         title="Админ-панель",
@@ -900,10 +3341,20 @@ def admin_panel():
             <div class="container">
                 <h2 style="margin-bottom: 30px; display: flex; justify-content: space-between; align-items: center;">
                     <span>Ожидающие платежи</span>
-                    <a href="/admin/logout" class="btn" style="padding: 5px 15px; font-size: 0.9rem;">Выйти</a>
+                    <span>
+                        <a href="/admin/export/csv" class="btn" style="padding: 5px 15px; font-size: 0.9rem;">Экспорт CSV</a>
+                        <a href="/admin/export/jsonl" class="btn" style="padding: 5px 15px; font-size: 0.9rem;">Экспорт JSONL</a>
+                        {{% if tenant.id == '{DEFAULT_TENANT_ID}' %}}<a href="/admin/profiler" class="btn" style="padding: 5px 15px; font-size: 0.9rem;">Профилировщик</a>{{% endif %}}
+                        <a href="/admin/sessions/revoke" class="btn" style="padding: 5px 15px; font-size: 0.9rem;">Выйти на всех устройствах</a>
+                        <a href="/admin/logout" class="btn" style="padding: 5px 15px; font-size: 0.9rem;">Выйти</a>
+                    </span>
                 </h2>
 
-                {message_html}
+                <div id="admin-message">{message_html}</div>
+
+                {ADMIN_SEARCH_HTML}
+
+                {_report_staleness_html()}
 
                 <div style="overflow-x: auto; margin-bottom: 30px;">
                     <table style="width: 100%; border-collapse: collapse;">
@@ -918,69 +3369,526 @@ def admin_panel():
                                 <th style="padding: 12px; text-align: left;">Действия</th>
                             </tr>
                         </thead>
-                        <tbody>
+                        <tbody id="payments-body" data-cursor="{cursor}">
                             {payment_rows}
                         </tbody>
                     </table>
                 </div>
             </div>
         </section>
+        {ADMIN_LIVE_JS}
         ''',
         year=datetime.now().year
-    ))
+    ), args={}, proxies=g.tenant.catalog.proxies, statuses=PAYMENT_TRANSITIONS)
 
 @app.route('/admin/delete/<payment_id>')
 @login_required
 def delete_payment(payment_id):
-    conn = sqlite3.connect('payments.db')
+    conn = _connect()
     c = conn.cursor()
-    c.execute("DELETE FROM payments WHERE payment_id=?", (payment_id,))
+    c.execute("DELETE FROM payments WHERE payment_id=? AND tenant_id=?", (payment_id, g.tenant.id))
+    deleted = c.rowcount > 0
     conn.commit()
     conn.close()
-
-    session['admin_message'] = ('Платеж удален', 'success')
-    return redirect('/admin')
+    success_pages.invalidate(payment_id)
+    payment_lookups.forget(payment_id)
+
+    if state_backend is not None:
+        record = _load_shared_payment(payment_id)
+        if record and record.get("tenant_id", DEFAULT_TENANT_ID) != g.tenant.id:
+            return _admin_result('Платеж не найден', 'error')
+        state_backend.delete(f"payment:{payment_id}")
+        state_backend.delete(f"payment:{payment_id}:credentials")
+        state_backend.srem("payments:pending", payment_id)
+        # Payment IDs are reused after deletion; a leftover claim would freeze the new payment
+        for status in PAYMENT_TRANSITIONS:
+            _release_shared_transition(payment_id, status)
+    elif not deleted:
+        return _admin_result('Платеж не найден', 'error')
+
+    audit("payment_deleted", payment_id=payment_id)
+    return _admin_result('Платеж удален', 'success')
 
 
 @app.route('/admin/confirm/<payment_id>')
 @login_required
 def confirm_payment(payment_id):
-    conn = sqlite3.connect('payments.db')
-    c = conn.cursor()
+    conn = _connect()
+    claimed = None
 
     try:
-        c.execute("SELECT region_id, country_id, quantity FROM payments WHERE payment_id=?", (payment_id,))
-        payment_info = c.fetchone()
+        if state_backend is not None:
+            claimed = _claim_shared_transition(conn, payment_id, "success", g.tenant.id)
+            if not claimed:
+                conn.rollback()
+                return _admin_result('Платеж не найден или уже обработан', 'error')
 
+        payment_info = _transition(conn, payment_id, "success", g.tenant.id)
         if not payment_info:
-            session['admin_message'] = ('Платеж не найден', 'error')
-            return redirect('/admin')
+            conn.rollback()
+            if claimed:
+                _release_shared_transition(payment_id, claimed)
+            return _admin_result('Платеж не найден или уже обработан', 'error')
+
+        quantity, = payment_info
+        proxies_data = _issue_credentials(conn, payment_id, quantity)
+        _notify_status(conn, payment_id, "success", g.tenant.id)
+        conn.commit()
+        payment_lookups.forget(payment_id)
+        job_queue.wake()
 
-        region_id, country_id, quantity = payment_info
-        proxies_data = _generate_proxy_data(quantity)
+        if state_backend is not None:
+            _publish_settled(payment_id, "success", g.tenant.id, proxies_data)
 
-        c.execute("UPDATE payments SET status=?, proxy_data=? WHERE payment_id=?",
-                 ('success', json.dumps(proxies_data), payment_id))
-        conn.commit()
+        audit("payment_confirmed", payment_id=payment_id, quantity=quantity)
+        return _admin_result('Платеж подтвержден! Данные прокси сгенерированы.', 'success')
+
+    except sqlite3.Error:
+        conn.rollback()
+        if claimed:
+            _release_shared_transition(payment_id, claimed)
+        return _admin_result('Ошибка при подтверждении платежа', 'error')
+    finally:
+        conn.close()
 
-        session['admin_message'] = ('Платеж подтвержден! Данные прокси сгенерированы.', 'success')
 
+def _change_status(payment_id, to_status, message):
+    conn = _connect()
+    claimed = None
+    try:
+        if state_backend is not None:
+            claimed = _claim_shared_transition(conn, payment_id, to_status, g.tenant.id)
+            if not claimed:
+                return _admin_result('Платеж не найден или уже обработан', 'error')
+        payment_info = _transition(conn, payment_id, to_status, g.tenant.id)
+        if payment_info:
+            _notify_status(conn, payment_id, to_status, g.tenant.id)
+        conn.commit()
     except sqlite3.Error:
-        session['admin_message'] = ('Ошибка при подтверждении платежа', 'error')
+        conn.rollback()
+        if claimed:
+            _release_shared_transition(payment_id, claimed)
+        return _admin_result('Ошибка при изменении статуса платежа', 'error')
     finally:
         conn.close()
 
-    return redirect('/admin')
+    if not payment_info:
+        if claimed:
+            _release_shared_transition(payment_id, claimed)
+        return _admin_result('Платеж не найден или уже обработан', 'error')
+
+    success_pages.invalidate(payment_id)
+    payment_lookups.forget(payment_id)
+    job_queue.wake()
+    if state_backend is not None:
+        _publish_settled(payment_id, to_status, g.tenant.id)
+
+    audit(f"payment_{to_status}", payment_id=payment_id)
+    return _admin_result(message, 'success')
+
+
+@app.route('/admin/cancel/<payment_id>')
+@login_required
+def cancel_payment(payment_id):
+    return _change_status(payment_id, "cancelled", 'Платеж отменен')
+
+
+@app.route('/admin/refund/<payment_id>')
+@login_required
+def refund_payment(payment_id):
+    return _change_status(payment_id, "refunded", 'Платеж отмечен как возвращенный')
+
+
+@app.route('/admin/history/<payment_id>')
+@login_required
+def payment_history(payment_id):
+    conn = _connect_readonly()
+    c = conn.cursor()
+    c.execute('''
+        SELECT from_status, to_status, changed_at FROM payment_transitions
+        WHERE payment_id=? AND EXISTS (SELECT 1 FROM payments WHERE payment_id=? AND tenant_id=?)
+        ORDER BY id
+    ''', (payment_id, payment_id, g.tenant.id))
+    transitions = [dict(zip(("from", "to", "changed_at"), row)) for row in c.fetchall()]
+    conn.close()
+    return jsonify(payment_id=payment_id, transitions=transitions)
+
+
+@app.route('/admin/jobs')
+@login_required
+def admin_jobs():
+    counts, failed = job_queue.stats(g.tenant.id)
+    return jsonify(
+        counts=counts,
+        failed=[dict(zip(("id", "kind", "attempts", "error", "created_at"), row)) for row in failed]
+    )
+
+
+@app.route('/admin/search')
+@login_required
+def admin_search():
+    where, params = _payment_filters(request.args)
+
+    conn = report_snapshot.connect()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT payment_id, region_id, country_id, amount, quantity, status, timestamp
+        FROM payments {where} ORDER BY timestamp DESC LIMIT ?
+    """, params + [ADMIN_SEARCH_LIMIT])
+    payments = c.fetchall()
+    conn.close()
+
+    payment_rows = "".join(_render_payment_row(*payment) for payment in payments)
+    if not payment_rows:
+        payment_rows = '<tr><td colspan="7" style="padding: 20px; text-align: center;">Ничего не найдено</td></tr>'
+
+    return render_template_string(BASE_HTML.format(
+        title="Поиск платежей",
+        content=f'''
+        <section style="padding: 40px 0; min-height: calc(100vh - 200px);">
+            <div class="container">
+                <h2 style="margin-bottom: 30px; display: flex; justify-content: space-between; align-items: center;">
+                    <span>Поиск платежей</span>
+                    <a href="/admin" class="btn" style="padding: 5px 15px; font-size: 0.9rem;">Все платежи</a>
+                </h2>
+
+                {ADMIN_SEARCH_HTML}
+
+                {_report_staleness_html()}
+
+                <p style="margin-bottom: 15px; color: #666;">Найдено: {len(payments)}{"+" if len(payments) == ADMIN_SEARCH_LIMIT else ""}</p>
 
+                <div style="overflow-x: auto; margin-bottom: 30px;">
+                    <table style="width: 100%; border-collapse: collapse;">
+                        <thead>
+                            <tr style="background: var(--mint-dark); color: white;">
+                                <th style="padding: 12px; text-align: left;">ID платежа</th>
+                                <th style="padding: 12px; text-align: left;">Страна</th>
+                                <th style="padding: 12px; text-align: left;">Сумма</th>
+                                <th style="padding: 12px; text-align: left;">Кол-во</th>
+                                <th style="padding: 12px; text-align: left;">Статус</th>
+                                <th style="padding: 12px; text-align: left;">Дата</th>
+                                <th style="padding: 12px; text-align: left;">Действия</th>
+                            </tr>
+                        </thead>
+                        <tbody>
+                            {payment_rows}
+                        </tbody>
+                    </table>
+                </div>
+            </div>
+        </section>
+        ''',
+        year=datetime.now().year
+    ), args=request.args, proxies=g.tenant.catalog.proxies, statuses=PAYMENT_TRANSITIONS)
 
 @app.route('/admin/logout')
 @login_required
 def admin_logout():
-    session.pop('admin_logged_in', None)
+    revoke_admin_session(session.pop('admin_token'))
+    audit("admin_logout")
     return redirect('/admin/login')
 
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=False)
+
+@app.route('/admin/sessions/revoke')
+@login_required
+def revoke_admin_sessions():
+    revoke_all_admin_sessions(g.tenant.id)
+    session.pop('admin_token', None)
+    audit("admin_sessions_revoked")
+    return redirect('/admin/login')
+
+def _fetch_changes(conn, since):
+    c = conn.cursor()
+    c.execute('''
+        SELECT change_seq, payment_id, region_id, country_id, amount, quantity, status, timestamp
+        FROM payments WHERE tenant_id = :tenant AND change_seq > :since
+        UNION ALL
+        SELECT change_seq, payment_id, NULL, NULL, NULL, NULL, NULL, NULL
+        FROM payment_deletions WHERE tenant_id = :tenant AND change_seq > :since
+        ORDER BY change_seq
+        LIMIT :limit
+    ''', {"tenant": g.tenant.id, "since": since, "limit": ADMIN_CHANGES_LIMIT})
+
+    changes = []
+    cursor = since
+    for change_seq, payment_id, *payment in c.fetchall():
+        cursor = change_seq
+        deleted = payment[4] is None
+        changes.append({
+            "payment_id": payment_id,
+            "html": None if deleted else _render_payment_row(payment_id, *payment)
+        })
+    return {"cursor": cursor, "changes": changes}
+
+
+def _parse_cursor(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+@app.route('/admin/changes')
+@login_required
+def admin_changes():
+    conn = _connect()
+    try:
+        return jsonify(_fetch_changes(conn, _parse_cursor(request.args.get('since'))))
+    finally:
+        conn.close()
+
+
+@app.route('/admin/stream')
+@login_required
+def admin_stream():
+    since = _parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+
+    def events(cursor):
+        conn = _connect()
+        deadline = time.monotonic() + ADMIN_STREAM_MAX_AGE
+        try:
+            yield "retry: 2000\n\n"
+            while time.monotonic() < deadline:
+                if state_backend is not None:
+                    _sync_shared_payments(conn, ADMIN_STREAM_POLL_INTERVAL)
+                batch = _fetch_changes(conn, cursor)
+                if batch["changes"]:
+                    cursor = batch["cursor"]
+                    yield f"id: {cursor}\nevent: changes\ndata: {json.dumps(batch, ensure_ascii=False)}\n\n"
+                    if len(batch["changes"]) == ADMIN_CHANGES_LIMIT:
+                        continue
+                else:
+                    # Heartbeat: lets the server notice a closed connection
+                    yield ": ping\n\n"
+                time.sleep(ADMIN_STREAM_POLL_INTERVAL)
+        finally:
+            conn.close()
+
+    # Streams end after ADMIN_STREAM_MAX_AGE; EventSource reconnects with Last-Event-ID
+    return Response(stream_with_context(events(since)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+# ============================================================================
+# ROUTES: EXPORT
+# ============================================================================
+
+EXPORT_COLUMNS = ("payment_id", "region_id", "country_id", "amount", "quantity", "status", "timestamp")
+
+
+def _iter_payment_rows(where, params):
+    conn = report_snapshot.connect()
+    try:
+        c = conn.cursor()
+        c.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM payments {where} ORDER BY timestamp", params)
+        while True:
+            rows = c.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def _export_csv(batches, columns=EXPORT_COLUMNS):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _export_jsonl(batches):
+    for rows in batches:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n"
+            for row in rows
+        )
+
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+EXPORT_FORMATS = {
+    "csv": (_export_csv, "text/csv"),
+    "jsonl": (_export_jsonl, "application/x-ndjson"),
+}
+
+
+@app.route('/admin/export/<fmt>')
+@login_required
+def export_payments(fmt):
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+
+    serializer, mimetype = EXPORT_FORMATS[fmt]
+    where, params = _payment_filters(request.args)
+    chunks = serializer(_iter_payment_rows(where, params))
+
+    filename = f"payments_{datetime.now():%Y%m%d_%H%M%S}.{fmt}"
+    if request.args.get('gzip') == '1':
+        chunks = _gzip_stream(chunks)
+        filename += ".gz"
+        mimetype = "application/gzip"
+
+    return Response(chunks, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    })
+
+
+# ============================================================================
+# ROUTES: PROFILER
+# ============================================================================
+
+PROFILER_HTML = """
+<section style="padding: 40px 0; min-height: calc(100vh - 200px);">
+    <div class="container">
+        <h2 style="margin-bottom: 30px; display: flex; justify-content: space-between; align-items: center;">
+            <span>Профилировщик</span>
+            <a href="/admin" class="btn" style="padding: 5px 15px; font-size: 0.9rem;">Все платежи</a>
+        </h2>
+
+        <div style="background: var(--text-light); padding: 25px; border-radius: 12px; margin-bottom: 30px;">
+            {% if profiler.active %}
+            <p style="margin-bottom: 15px;">
+                <strong>Сэмплирование включено</strong>
+                {% if profiler.endpoint %} для маршрута <code>{{ profiler.endpoint }}</code>{% endif %}
+                {% if remaining_seconds is not none %}, осталось {{ remaining_seconds }} с{% endif %}
+                {% if profiler.remaining_requests is not none %}, осталось запросов: {{ profiler.remaining_requests }}{% endif %}
+            </p>
+            <form method="POST" action="/admin/profiler/stop" style="margin-bottom: 15px;">
+                <button type="submit" class="btn" style="background-color: #e74c3c;">Остановить</button>
+            </form>
+            {% else %}
+            <form method="POST" action="/admin/profiler/start" style="display: flex; flex-wrap: wrap; gap: 10px; margin-bottom: 15px;">
+                <input type="number" min="1" name="seconds" placeholder="Секунд"
+                       style="flex: 0 1 120px; padding: 8px; border: 1px solid #ddd; border-radius: 6px;">
+                <input type="number" min="1" name="requests" placeholder="Запросов"
+                       style="flex: 0 1 120px; padding: 8px; border: 1px solid #ddd; border-radius: 6px;">
+                <select name="endpoint" style="flex: 0 1 220px; padding: 8px; border: 1px solid #ddd; border-radius: 6px;">
+                    <option value="">Все маршруты</option>
+                    {% for endpoint in endpoints %}
+                    <option value="{{ endpoint }}">{{ endpoint }}</option>
+                    {% endfor %}
+                </select>
+                <button type="submit" class="btn" style="padding: 8px 20px;">Включить</button>
+            </form>
+            {% endif %}
+            <p>
+                Сэмплов в профиле: {{ samples }}
+                {% if samples %}&mdash; <a href="/admin/profiler/profile.folded">скачать (collapsed stacks)</a>{% endif %}
+            </p>
+        </div>
+
+        <h3 style="margin-bottom: 15px;">Медленные запросы (порог {{ threshold_ms }} мс)</h3>
+        {% for capture in captures %}
+        <div style="background: var(--text-light); padding: 20px; border-radius: 12px; margin-bottom: 15px;">
+            <p style="margin-bottom: 10px;">
+                <strong>{{ capture.method }} {{ capture.path }}</strong>
+                &mdash; {{ (capture.duration * 1000) | round(1) }} мс, статус {{ capture.status }},
+                {{ capture.time.strftime('%Y-%m-%d %H:%M:%S') }}
+            </p>
+            <p style="margin-bottom: 10px;">
+                SQL: {{ capture.sql | length }} запросов, {{ (capture.sql_total * 1000) | round(1) }} мс;
+                шаблоны: {{ (capture.template_total * 1000) | round(1) }} мс;
+                сэмплов стека: {{ capture.stacks.values() | sum }}
+                {% if capture.stacks %}&mdash; <a href="/admin/profiler/slow/{{ capture.id }}.folded">скачать</a>{% endif %}
+            </p>
+            {% for sql, elapsed in capture.sql[:5] %}
+            <p style="font-size: 0.9rem;"><code>{{ (elapsed * 1000) | round(2) }} мс &mdash; {{ sql | truncate(160) }}</code></p>
+            {% endfor %}
+        </div>
+        {% else %}
+        <p style="color: #666;">Пока нет запросов дольше порога.</p>
+        {% endfor %}
+    </div>
+</section>
+"""
+
+
+@app.route('/admin/profiler')
+@operator_required
+def profiler_panel():
+    profiler.sync()
+    remaining_seconds = None
+    if profiler.active and profiler.deadline is not None:
+        remaining_seconds = max(0, round(profiler.deadline - time.time()))
+
+    return render_template_string(
+        BASE_HTML.format(
+            title="Профилировщик",
+            content=PROFILER_HTML,
+            year=datetime.now().year
+        ),
+        profiler=profiler,
+        remaining_seconds=remaining_seconds,
+        endpoints=sorted(rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint != 'static'),
+        samples=sum(profiler.profile().values()),
+        captures=profiler.captures(),
+        threshold_ms=SLOW_REQUEST_THRESHOLD_MS
+    )
+
+
+def _positive_int(value):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number > 0 else None
+
+
+@app.route('/admin/profiler/start', methods=['POST'])
+@operator_required
+def profiler_start():
+    audit("profiler_started", endpoint=request.form.get('endpoint') or None)
+    profiler.start(
+        seconds=_positive_int(request.form.get('seconds')),
+        requests=_positive_int(request.form.get('requests')),
+        endpoint=request.form.get('endpoint') or None
+    )
+    return redirect('/admin/profiler')
+
+
+@app.route('/admin/profiler/stop', methods=['POST'])
+@operator_required
+def profiler_stop():
+    profiler.stop()
+    return redirect('/admin/profiler')
+
+
+@app.route('/admin/profiler/profile.folded')
+@operator_required
+def profiler_download():
+    profiler.sync()
+    body = _format_collapsed(profiler.profile())
+    return Response(body, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="profile_{datetime.now():%Y%m%d_%H%M%S}.folded"'
+    })
+
+
+@app.route('/admin/profiler/slow/<int:capture_id>.folded')
+@operator_required
+def profiler_slow_download(capture_id):
+    capture = profiler.capture(capture_id)
+    if capture is None:
+        abort(404)
+    return Response(_format_collapsed(capture["stacks"]), mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="slow_{capture_id}.folded"'
+    })
 
 
 # ============================================================================
@@ -1025,5 +3933,22 @@ def server_error(error):
 # RUN
 # ============================================================================
 
+init_db()
+issued_credentials.preload()
+
+if CATALOG_POLL_INTERVAL > 0:
+    start_catalog_watcher()
+
+profiler.ensure_sampler()
+
+if PAYMENT_EXPIRY_HOURS > 0:
+    start_payment_expiry()
+
+if REPORT_REFRESH_INTERVAL > 0:
+    report_snapshot.start()
+
+if JOB_WORKERS > 0:
+    job_queue.start(JOB_WORKERS)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=False)
\ No newline at end of file